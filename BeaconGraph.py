@@ -8,25 +8,44 @@ import dash_daq as daq
 import dash_html_components as html
 import dash_cytoscape as cyto
 import dash_core_components as dcc
-import bg_parsers
+from bg_jobs import IngestQueue
+from bg_layout import LayoutCache
+from bg_elements import ElementHistory
+from bg_watch import CaptureWatcher
+from bg_pool import PoolTimeout
+import bg_metrics
+from bg_metrics import timedCallback
 from collections import Counter
 from time import sleep
-from dash.dependencies import Output, Input, State
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtWebEngineWidgets import QWebEngineView
-from bg_gui import Form, BeaconView
+from dash.dependencies import Output, Input, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+
+# Server side callbacks that can be picked for a cProfile capture in the Settings tab
+CALLBACK_NAMES = ['handleSearch', 'updateSearchNames', 'displayDBData', 'displayTapNodeData', 'updateLegend', 'handleUpload']
 
 class BeaconGraph():
     def __init__(self, neo, parent=None):
         self.app = dash.Dash("BeaconGraph")
         self.app.title = "BeaconGraph"
-        elements = neo.initialQuery()
-
-        self.app.layout = html.Div(className="container", children=[
-            html.Div(className="pageDiv", children=[
-            cyto.Cytoscape(
-                id='cytoscape',
-                layout={'name': 'cose',
+        self.ingest = IngestQueue(neo, neo.PARSE_WORKERS)
+        # Server layout sends positions with a 'preset' layout, client layout runs cose in the browser
+        self.layout = LayoutCache() if neo.LAYOUT_ENGINE == "server" else None
+        self.history = ElementHistory()
+        self.watcher = None
+        if neo.WATCH_PATHS:
+            watcher = CaptureWatcher(neo, neo.WATCH_PATHS, neo.WATCH_INTERVAL, neo.WATCH_FLUSH_INTERVAL)
+            if watcher.start():
+                self.watcher = watcher
+        bg_metrics.register(self.app.server)
+        bg_metrics.REGISTRY.gauges('beacongraph_result_cache', "Search result cache counters",
+                        lambda: [({'stat': k}, v) for k, v in neo.resultCache.stats().items()])
+        if hasattr(neo.store, 'pool'):
+            bg_metrics.REGISTRY.gauges('beacongraph_pool', "Database session pool, wait times in seconds",
+                        lambda: [({'stat': k}, v) for k, v in neo.store.pool.stats().items() if k != 'waitByQuery'])
+        if self.layout:
+            layout = {'name': 'preset', 'padding': 200, 'fit': True}
+        else:
+            layout = {'name': 'cose',
                         'weaver': True,
                         'componentSpacing': 130,
                         'nodeRepulsion' : 150000,
@@ -34,7 +53,14 @@ class BeaconGraph():
                         'idealEdgeLength': 100,
                         'nodeDimensionsIncludeLabels': True,
                         'padding': 200,
-                        'fit': True},
+                        'fit': True}
+        elements = neo.initialQuery()
+
+        self.app.layout = html.Div(className="container", children=[
+            html.Div(className="pageDiv", children=[
+            cyto.Cytoscape(
+                id='cytoscape',
+                layout=layout,
                 style={'width': '100%', 'height': "100%"},
                 elements={},
                 stylesheet=[
@@ -117,6 +143,23 @@ class BeaconGraph():
                             'background-color': neo.AP_COLOR          
                         }
                     },
+                    {
+                        'selector': 'node[type = "Cluster"]',
+                        'style': {
+                            'background-color': neo.AP_COLOR,
+                            'border-color': 'white',
+                            'border-width': 2,
+                            'width': 'mapData(count, 1, 1000, 30, 120)',
+                            'height': 'mapData(count, 1, 1000, 30, 120)'
+                        }
+                    },
+                    {
+                        'selector': 'edge[count > 1]',
+                        'style': {
+                            'width': 'mapData(count, 1, 1000, 2, 16)',
+                            'label': 'data(count)'
+                        }
+                    },
                     {
                         'selector': 'edge[name = "Probes"]',
                         'style': {
@@ -169,7 +212,16 @@ class BeaconGraph():
                                         {'label': 'LAN IP', 'value': 'lan'}
                                         ], value='name')
                                     ]),
-                                    html.Td(className='filtervalue', children=dcc.Dropdown(id='filtervalue-dropdown', placeholder="Search", multi=True, options=neo.names))
+                                    html.Td(className='filtervalue', children=dcc.Dropdown(id='filtervalue-dropdown', placeholder="Search", multi=True, options=[]))
+                                ]),
+                                html.Tr(className="tablerows", children=[
+                                    html.Td(className="filtername", children="Cluster"),
+                                    html.Td(className='filtervalue', children=dcc.Dropdown(id='cluster-dropdown', searchable=False, clearable=False, options=[
+                                        {'label': 'Encryption', 'value': 'type'},
+                                        {'label': 'Channel', 'value': 'channel'},
+                                        {'label': 'OUI Vendor', 'value': 'oui'},
+                                        {'label': 'ESSID', 'value': 'name'}
+                                        ], value=neo.CLUSTER_BY))
                                 ]),
                             ]),
                         html.Div(id='node-content-div', children=[
@@ -182,14 +234,20 @@ class BeaconGraph():
                     ])]),
                     dcc.Tab(label="Settings", value="settings", className='custom-tab', children=[
                         html.Div(id='settings-content-div', children=[
-                            
+                            html.Pre(id='metrics-content', className="dbinfocontent"),
+                            dcc.Dropdown(id='profile-dropdown', searchable=False, placeholder="Profile the next call of...",
+                                options=[{'label': name, 'value': name} for name in CALLBACK_NAMES]),
+                            html.Pre(id='profile-content', className="dbinfocontent"),
+                            dcc.Interval(id='metrics-interval', interval=5000)
                     ])])    
                 ])
             ]),
 
             #Lower right
             html.Div(id='log-div', children=[
-                html.Pre(id='log-content', className="logDiv")
+                html.Pre(id='log-content', className="logDiv", children=self.ingest.status()),
+                html.Button('Cancel Upload', id='cancel-ingest', className="bgbutton"),
+                dcc.Interval(id='ingest-interval', interval=1000)
             ]),
 
             #Icons - upper left
@@ -201,17 +259,62 @@ class BeaconGraph():
                     #html.Span(className="tooltiptext", children="Export Data")])
             ]),
 
-            html.Div(id='hidden-upload-div')
+            html.Div(id='hidden-upload-div', children=str(neo.settledVersion)),
+            dcc.Store(id='elements-delta'),
+            dcc.Store(id='elements-version'),
+            html.Div(id='upload-job-div'),
+            html.Div(id='cancel-ingest-div')
         ])
 
-        @self.app.callback(Output('cytoscape', 'elements'), [Input('filtervalue-dropdown', 'value')], [State("filtername-dropdown", "value")])
-        def handleSearch(value, prop):
-            if value and not neo.INITIAL:
-                return neo.searchQuery(value, prop)
-            else:
-                return {}
+        @self.app.callback(Output('elements-delta', 'data'), [Input('filtervalue-dropdown', 'value'), Input('cluster-dropdown', 'value'),
+                            Input('cytoscape', 'tapNodeData'), Input('hidden-upload-div', 'children')],
+                            [State("filtername-dropdown", "value"), State('elements-version', 'data')])
+        @timedCallback
+        def handleSearch(value, clusterBy, tapped, dataVersion, prop, version):
+            # Only the difference to the graph on screen is sent, the browser applies it in applyDelta
+            current = self.history.get(version)
+            triggered = dash.callback_context.triggered
+            trigger = triggered[0]['prop_id'] if triggered else None
+            expand = trigger == 'cytoscape.tapNodeData'
+            # Only cluster taps change the elements, they expand in place
+            if expand and (not tapped or tapped.get('type') != "Cluster" or not value):
+                raise PreventUpdate
+            # New data (uploads, live captures) re-runs the search on screen so only the new elements are sent
+            if trigger == 'hidden-upload-div.children' and (not value or current is None):
+                raise PreventUpdate
+            try:
+                if expand:
+                    result = neo.searchQuery(value, prop)
+                    if current is None:
+                        # The graph on screen was sent by another server worker or has been evicted from
+                        # the history, the clustered search is rebuilt from the cached result
+                        current = neo.levelOfDetail(result, clusterBy)
+                    elements = neo.expandCluster(current, tapped['id'], result, clusterBy)
+                    if elements is None:
+                        # A nested cluster from a view this worker no longer has
+                        raise PreventUpdate
+                elif value and not neo.INITIAL:
+                    elements = neo.levelOfDetail(neo.searchQuery(value, prop), clusterBy)
+                else:
+                    elements = {'nodes': [], 'edges': []}
+            except PoolTimeout as e:
+                # Every session is busy, keep the graph on screen rather than blanking it
+                print(e)
+                raise PreventUpdate
+
+            if self.layout:
+                onScreen = {node['data']['id'] for node in current['nodes']} if current else None
+                elements = self.layout.apply(elements, onScreen)
+            return self.history.delta(version, elements, lockExisting=self.layout is None)
+
+        self.app.clientside_callback(ClientsideFunction('beacongraph', 'applyDelta'), Output('cytoscape', 'elements'),
+                            [Input('elements-delta', 'data')], [State('cytoscape', 'elements')])
+
+        self.app.clientside_callback(ClientsideFunction('beacongraph', 'deltaVersion'), Output('elements-version', 'data'),
+                            [Input('elements-delta', 'data')])
 
         @self.app.callback(Output('node-content', 'children'), [Input('cytoscape', 'tapNodeData'), Input('data-tabs', 'value')])
+        @timedCallback
         def displayTapNodeData(data, tab):
             if not data:
                 data = {}
@@ -230,6 +333,7 @@ class BeaconGraph():
             return content
 
         @self.app.callback(Output('data-tabs', 'value'), [Input('cytoscape', 'tapNodeData')])
+        @timedCallback
         def switchToNodeTab(data):
             return "node-data"
 
@@ -239,16 +343,27 @@ class BeaconGraph():
                         html.Td(className="rowvalue", children=value)
                     ])
 
-        @self.app.callback(Output('filtervalue-dropdown', 'options'), [Input('cytoscape', 'elements'), 
-                    Input('filtername-dropdown', 'value'), Input('hidden-upload-div', 'children'), Input('hiddendb-div', 'children')])
-        def updateSearchNames(eles, searchName, uploadEntry, hiddenDB):
-            searchOpts = {'name': neo.getNames, 'bssid': neo.getBssids, 'oui': neo.getOUIs, 'type': neo.getTypes, 
-                            'auth': neo.getAuths, 'cipher': neo.getCiphers, 'channel': neo.getChannels, 'speed': neo.getSpeeds, 'lan': neo.getLanIPs}
-            
-            return [{'label': opt, 'value': opt} for opt in searchOpts[searchName]()]
+        @self.app.callback(Output('filtervalue-dropdown', 'options'), [Input('filtervalue-dropdown', 'search_value'), 
+                    Input('filtername-dropdown', 'value'), Input('hidden-upload-div', 'children'), Input('hiddendb-div', 'children')],
+                    [State('filtervalue-dropdown', 'value')])
+        @timedCallback
+        def updateSearchNames(search, searchName, uploadEntry, hiddenDB, selected):
+            # Only the top matches for what has been typed so far are sent to the browser
+            try:
+                matches = neo.searchCatalog(searchName, search)
+            except PoolTimeout as e:
+                print(e)
+                raise PreventUpdate
+            options = [{'label': f"{opt} ({cnt})", 'value': opt} for opt, cnt in matches]
+
+            # Selected values have to stay in the options or the dropdown drops them
+            shown = {opt['value'] for opt in options}
+            options += [{'label': str(opt), 'value': opt} for opt in (selected or []) if opt not in shown]
+            return options
 
         @self.app.callback(Output('db-content', 'children'), [Input('cytoscape', 'elements'), 
                             Input('hidden-upload-div', 'children'), Input('hiddendb-div', 'children')])
+        @timedCallback
         def displayDBData(eles, uploadEntry, hiddenDB):
             stats = neo.getDbStats()
             content = html.Table(id='data-table', className='nodetable', children=[
@@ -261,12 +376,15 @@ class BeaconGraph():
                 makeTableRow("WEP", stats['WEP'] or "0"),
                 makeTableRow("Open", stats['Open'] or "0"),
                 makeTableRow("Probes", stats['Probes'] or "0"),
-                makeTableRow("Associations", stats['Assoc'] or "0")        
+                makeTableRow("Associations", stats['Assoc'] or "0"),
+                makeTableRow("Indexes", neo.indexSummary()),
+                makeTableRow("Sessions", neo.store.summary())
                 ])
 
             return content    
 
         @self.app.callback(Output('legend-div', 'children'), [Input('cytoscape', 'elements')])
+        @timedCallback
         def updateLegend(eles):
             if eles.get('nodes'):
                 eleCounter = Counter([ele['data']['type'] for ele in eles['nodes']])
@@ -306,16 +424,65 @@ class BeaconGraph():
                 ]),
             ])
 
-        @self.app.callback(Output('hidden-upload-div', 'children'), [Input('upload-data', 'contents')])
-        def handleUpload(contentList):
-            if contentList is not None:
-                for content in contentList:
-                    dType, *data = bg_parsers.parseUpload(content)
-                    neo.handleIncomingData(dType, data)
-                    
+        @self.app.callback(Output('upload-job-div', 'children'), [Input('upload-data', 'contents')], [State('upload-data', 'filename')])
+        @timedCallback
+        def handleUpload(contentList, nameList):
+            # Parsing and inserting run on the ingest worker, progress shows up in the log panel
+            if contentList is None:
+                return ""
+            return str(self.ingest.submit(contentList, nameList))
+
+        @self.app.callback(Output('log-content', 'children'), [Input('ingest-interval', 'n_intervals'), Input('upload-job-div', 'children')])
+        @timedCallback
+        def displayIngestStatus(n, jobId):
+            # Server workers without uploads or a capture of their own leave the panel to the one that has them
+            if not self.ingest.jobs and not self.watcher:
+                raise PreventUpdate
+            if self.watcher:
+                return self.watcher.status() + "\n" + self.ingest.status()
+            return self.ingest.status()
+
+        @self.app.callback(Output('hidden-upload-div', 'children'), [Input('ingest-interval', 'n_intervals')], [State('hidden-upload-div', 'children')])
+        @timedCallback
+        def ingestFinished(n, seen):
+            # Only fire once an ingest finished writing so counts and dropdowns refresh a single time.
+            # Jobs in other server workers settle the same shared version.
+            version = str(neo.settledVersion)
+            if version == seen:
+                raise PreventUpdate
+            return version
+
+        @self.app.callback(Output('cancel-ingest-div', 'children'), [Input('cancel-ingest', 'n_clicks')])
+        @timedCallback
+        def cancelIngest(n_clicks):
+            if n_clicks:
+                self.ingest.cancel()
             return ""
 
+        @self.app.callback(Output('metrics-content', 'children'), [Input('metrics-interval', 'n_intervals'), Input('data-tabs', 'value')])
+        def displayMetrics(n, tab):
+            # Only worth rendering while the Settings tab is open
+            if tab != "settings":
+                raise PreventUpdate
+            cache = neo.resultCache.stats()
+            return "\n".join([bg_metrics.summary(), "",
+                    f"Result cache: {cache['entries']} entries, {cache['bytes'] / 1048576:.1f} MB, hit rate {cache['hitRate']:.0%}",
+                    f"Sessions: {neo.store.summary()}", "", "Full histograms at /metrics"])
+
+        @self.app.callback(Output('profile-content', 'children'), [Input('profile-dropdown', 'value'), Input('metrics-interval', 'n_intervals')],
+                    [State('profile-content', 'children')])
+        def displayProfile(name, n, shown):
+            if dash.callback_context.triggered and dash.callback_context.triggered[0]['prop_id'] == 'profile-dropdown.value':
+                if name:
+                    bg_metrics.PROFILER.arm(name)
+                    return f"Waiting for the next call of {name}..."
+                raise PreventUpdate
+            if not bg_metrics.PROFILER.report or bg_metrics.PROFILER.report == shown:
+                raise PreventUpdate
+            return bg_metrics.PROFILER.report
+
         @self.app.callback(Output('hiddendb-div', 'children'), [Input('deletedb-provider', 'submit_n_clicks')])
+        @timedCallback
         def deleteDatabase(sub_clicks):
             if not sub_clicks:
                 return ""
@@ -323,6 +490,10 @@ class BeaconGraph():
             return ""
 
 if __name__ == '__main__':
+    # Desktop mode, bg_server.py runs the same app headless without Qt
+    from PyQt5.QtWidgets import QApplication
+    from bg_gui import Form, BeaconView
+
     qt_app  = QApplication(sys.argv)
     form = Form()
     form.show()
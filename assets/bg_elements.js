@@ -0,0 +1,64 @@
+// Applies the element deltas computed by bg_elements.ElementHistory to the graph on screen
+
+// Nodes locked through their element data when Cytoscape itself could not be reached
+var lockedByDelta = new Set();
+
+function cytoscapeInstance() {
+    // dash-cytoscape does not expose Cytoscape, cytoscape.js registers itself on its container
+    var root = document.getElementById('cytoscape');
+    if (!root) {
+        return null;
+    }
+    var candidates = [root].concat(Array.prototype.slice.call(root.querySelectorAll('div')));
+    for (var i = 0; i < candidates.length; i++) {
+        if (candidates[i]._cyreg && candidates[i]._cyreg.cy) {
+            return candidates[i]._cyreg.cy;
+        }
+    }
+    return null;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    beacongraph: {
+        applyDelta: function(delta, current) {
+            var previous = lockedByDelta;
+            lockedByDelta = new Set();
+            if (!delta) {
+                return {nodes: [], edges: []};
+            }
+            if (delta.full) {
+                return {nodes: delta.add.nodes, edges: delta.add.edges};
+            }
+
+            var removed = new Set(delta.remove.map(String));
+            var keep = function(ele) { return !removed.has(String(ele.data.id)); };
+            current = current || {};
+
+            var nodes = (current.nodes || []).filter(keep).map(function(node) {
+                // Locks from the previous delta never outlive it
+                return previous.has(String(node.data.id)) ? Object.assign({}, node, {locked: false}) : node;
+            });
+            if (delta.lockExisting) {
+                // Only the new nodes move when the client layout runs. The others are held in place
+                // for that layout and can be dragged again once it stops.
+                var ids = new Set(nodes.map(function(node) { return String(node.data.id); }));
+                var cy = cytoscapeInstance();
+                if (cy) {
+                    var held = cy.nodes().filter(function(node) { return ids.has(String(node.id())); }).lock();
+                    cy.one('layoutstop', function() { held.unlock(); });
+                } else {
+                    nodes = nodes.map(function(node) { return Object.assign({}, node, {locked: true}); });
+                    lockedByDelta = ids;
+                }
+            }
+            return {
+                nodes: nodes.concat(delta.add.nodes),
+                edges: (current.edges || []).filter(keep).concat(delta.add.edges)
+            };
+        },
+
+        deltaVersion: function(delta) {
+            return delta ? delta.version : null;
+        }
+    }
+});
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# dataToJSON on synthetic search results: legacy quadratic merge vs the streamed linear merge.
+# Usage: python benchmarks/bench_datatojson.py [sizes...]   (default 1000 10000 100000)
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from neoHandler import neoHandler
+
+# The legacy merge is O(n^2), skip it past this many nodes
+LEGACY_MAX = 20000
+
+def legacyDataToJSON(relationJSON):
+    checkDupes, returnJson = {}, {}
+    returnJson['nodes'] = []
+    returnJson['edges'] = []
+
+    for node in relationJSON['nodes']:
+        node['type'] = node['type'][0]
+        if node['id'] not in checkDupes.values():
+            # The original keyed this by idx, which points at the wrong node after the first merge
+            checkDupes[len(returnJson['nodes'])] = node['id']
+            returnJson['nodes'].append({"data": node, "selected": 'false', "group": "nodes"})
+        else:
+            inDupe = [key for (key, value) in checkDupes.items() if value == node['id']][0]
+            if node['type'] == "Client":
+                node = {**node, **returnJson['nodes'][inDupe]['data']}
+            else:
+                node = {**returnJson['nodes'][inDupe]['data'], **node}
+            returnJson['nodes'][inDupe]['data'] = node
+
+    for edge in relationJSON['edges']:
+        returnJson['edges'].append({"data": edge, "selected": 'false', "group": "edges"})
+
+    return returnJson
+
+def syntheticRows(nodes, seed=1):
+    # One row per relationship, like the search presets return. A few clients are also APs (mesh).
+    rnd = random.Random(seed)
+    apCount = max(1, nodes // 4)
+    rows = []
+    for c in range(nodes - apCount):
+        cid = apCount + c if rnd.random() > 0.01 else rnd.randrange(apCount)
+        ap = rnd.randrange(apCount)
+        rows.append({
+            'a': {'id': cid, 'name': f"client{cid}", 'type': ["Client", "Device"], 'bssid': f"{cid:012x}", 'pwr': "-60"},
+            'b': {'id': ap, 'name': f"ap{ap}", 'type': ["WPA2", "Device"], 'bssid': f"{ap:012x}", 'channel': "6"},
+            'edge': {'id': f"{cid}-Probes-{ap}", 'source': cid, 'target': ap, 'name': "Probes"}})
+    return rows
+
+def collected(rows):
+    # What the old single-map RETURN {nodes: collect(distinct ...), edges: ...} produced
+    nodes, seen, edges, seenEdges = [], set(), [], set()
+    for row in rows:
+        for key in ('a', 'b'):
+            marker = (row[key]['id'], row[key]['type'][0], row[key]['name'])
+            if marker not in seen:
+                seen.add(marker)
+                nodes.append(dict(row[key], type=list(row[key]['type'])))
+        if row['edge']['id'] not in seenEdges:
+            seenEdges.add(row['edge']['id'])
+            edges.append(row['edge'])
+    return {'nodes': nodes, 'edges': edges}
+
+def timed(fn, arg):
+    start = perf_counter()
+    result = fn(arg)
+    return perf_counter() - start, result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'nodes':>8} {'rows':>8} {'legacy s':>10} {'linear s':>10} {'speedup':>8}")
+    for size in sizes:
+        rows = syntheticRows(size)
+        linear, result = timed(lambda r: neoHandler.dataToJSON(None, iter(r)), [{k: dict(v) for k, v in row.items()} for row in rows])
+        if size <= LEGACY_MAX:
+            legacy, _ = timed(legacyDataToJSON, collected(rows))
+            print(f"{size:>8} {len(rows):>8} {legacy:>10.3f} {linear:>10.3f} {legacy / linear:>7.1f}x")
+        else:
+            print(f"{size:>8} {len(rows):>8} {'skipped':>10} {linear:>10.3f} {'-':>8}")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Server-side layout timings for synthetic search results, cold and with cached coordinates.
+# The browser's cose layout cannot run headless; compare against its timing in the devtools
+# profiler with [layout] Engine = client.
+# Usage: python benchmarks/bench_layout.py [sizes...]   (default 1000 5000 20000)
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bg_layout import LayoutCache
+from bench_datatojson import syntheticRows
+
+def elements(size, seed=1):
+    nodes, edges = {}, {}
+    for row in syntheticRows(size, seed):
+        for key in ('a', 'b'):
+            nodes.setdefault(row[key]['id'], {"data": dict(row[key], type=row[key]['type'][0]), "group": "nodes"})
+        edges.setdefault(row['edge']['id'], {"data": row['edge'], "group": "edges"})
+    return {'nodes': list(nodes.values()), 'edges': list(edges.values())}
+
+def timed(cache, els):
+    start = perf_counter()
+    cache.apply(els)
+    return perf_counter() - start
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 5000, 20000]
+    print(f"{'nodes':>8} {'edges':>8} {'cold s':>8} {'cached s':>9} {'payload KB':>11}")
+    for size in sizes:
+        cache = LayoutCache()
+        els = elements(size)
+        cold = timed(cache, els)
+        # Same search again with a few extra results, most coordinates come from the cache
+        warm = timed(cache, elements(size + size // 10))
+        payload = len(json.dumps(els)) / 1024
+        print(f"{size:>8} {len(els['edges']):>8} {cold:>8.2f} {warm:>9.2f} {payload:>11.0f}")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Airodump row parsing throughput: legacy cleanup + pandas vs the single-pass tokenizer.
+# Usage: python benchmarks/bench_parsers.py [scale]
+import io
+import os
+import sys
+import contextlib
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bg_parsers
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+
+def legacyParse(header, lines, station=False):
+    # The pre-tokenizer path: rebuild the CSV text, then round trip it through pandas
+    import pandas as pd
+    cleanList = [",".join(map(str.strip, header.split(",")))]
+    for line in lines:
+        items = list(map(str.strip, line.split(",")))
+        if station:
+            essids = "|" + ",".join(items[6:]) + "|"
+            newList = [item for item in items if item not in items[6:]]
+            newList.append(essids)
+            cleanList.append(",".join(newList))
+        else:
+            cleanList.append(",".join(items))
+
+    df = pd.read_csv(io.StringIO("\n".join(cleanList)), quotechar="|" if station else '"', header=0)
+    df.fillna("", inplace=True)
+    return df.to_dict(orient='records')
+
+def loadTables(path, scale):
+    tables, section = {}, None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.startswith("BSSID,") or line.startswith("Station MAC,"):
+                section = "Station" if line.startswith("Station MAC,") else "AP"
+                tables[section] = (line, [])
+            elif section and line.strip():
+                tables[section][1].append(line)
+
+    return {k: (header, rows * scale) for k, (header, rows) in tables.items()}
+
+def rowsPerSec(fn, header, rows, station):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        fn(header, rows, station)
+        elapsed = perf_counter() - start
+    return len(rows) / elapsed
+
+if __name__ == '__main__':
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tokenize = getattr(bg_parsers, "__tokenize")
+    print(f"{'sample':<8} {'table':<8} {'rows':>9} {'legacy rows/s':>14} {'tokenizer rows/s':>17} {'speedup':>8}")
+    for name in ("walk", "flight"):
+        for section, (header, rows) in loadTables(os.path.join(SAMPLES, f"{name}.csv"), scale).items():
+            station = section == "Station"
+            before = rowsPerSec(legacyParse, header, rows, station)
+            after = rowsPerSec(tokenize, header, rows, station)
+            print(f"{name:<8} {section:<8} {len(rows):>9} {before:>14.0f} {after:>17.0f} {after / before:>7.1f}x")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# End to end: synthetic airodump capture -> parseUpload -> OUI lookup -> insertAiroData -> catalog,
+# searches, dataToJSON and stats, each stage timed on its own. Results are printed as a table and
+# written as JSON so runs can be compared across versions.
+# Usage: python benchmarks/bench_pipeline.py [--aps N] [--stations N] [--backend embedded|neo4j] [--output results.json]
+# The neo4j backend uses the [neo4j] settings and DELETES the database before inserting.
+# --write-capture PATH only writes the generated CSV.
+import argparse
+import base64
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+# neoHandler reads settings.cfg from the working directory when it is imported
+CWD = os.getcwd()
+os.chdir(ROOT)
+import bg_oui
+import bg_parsers
+import neoHandler as handlerModule
+
+AP_HEADER = ("BSSID, First time seen, Last time seen, channel, Speed, Privacy, Cipher, Authentication, Power, "
+            "# beacons, # IV, LAN IP, ID-length, ESSID, Key")
+STATION_HEADER = "Station MAC, First time seen, Last time seen, Power, # packets, BSSID, Probed ESSIDs"
+
+# Rough mix seen in samples/walk.csv
+CHANNELS = [1] * 6 + [6] * 6 + [11] * 6 + [2, 3, 4, 5, 7, 8, 9, 10, 36, 40, 44, 48, 149, 153, 157, 161]
+SPEEDS = [54, 130, 195, 270, 360, 540]
+PRIVACY = [("WPA2", "CCMP", "PSK")] * 12 + [("WPA2", "CCMP", "MGT")] * 2 + [("WPA2 WPA", "CCMP TKIP", "PSK")] * 2 + \
+            [("OPN", "", "")] * 4 + [("WPA", "TKIP", "PSK"), ("WEP", "WEP", "")]
+OUIS = ["00:25:00", "3C:37:86", "44:1C:12", "60:5F:8D", "AC:BC:32", "B8:27:EB", "DC:FE:07", "F4:F5:D8", "00:0C:6E", "10:C3:7B"]
+WORDS = ["Home", "Guest", "xfinitywifi", "NETGEAR", "Linksys", "Cafe", "Office", "ATT", "Spectrum", "Library",
+            "Printer", "Blanche", "Tonight", "Centaur", "Lab", "Mesh", "Lobby", "5G", "Upstairs", "Pool"]
+
+def randomMac(rnd, oui=None):
+    if oui is None:
+        # Randomized (locally administered) address, as phones send while probing
+        first = (rnd.randrange(256) | 0x02) & 0xFE
+        octets = [first] + [rnd.randrange(256) for _ in range(5)]
+        return ":".join(f"{o:02X}" for o in octets)
+    return oui + ":" + ":".join(f"{rnd.randrange(256):02X}" for _ in range(3))
+
+def randomEssid(rnd, commaRate):
+    words = rnd.sample(WORDS, rnd.randint(1, 3))
+    if rnd.random() < commaRate:
+        return ", ".join(words)
+    return rnd.choice(["", "-", "_", " "]).join(words) + (str(rnd.randrange(100)) if rnd.random() < 0.5 else "")
+
+def generateCapture(aps=2000, stations=8000, probeFanout=2.0, meshRate=0.01, hiddenRate=0.1, commaRate=0.02,
+                    assocRate=0.6, seed=1):
+    # Returns the CSV bytes airodump-ng would write, CRLF line endings and all
+    rnd = random.Random(seed)
+    start = datetime(2019, 4, 10, 23, 15, 0)
+    def seen():
+        first = start + timedelta(seconds=rnd.randrange(1800))
+        last = first + timedelta(seconds=rnd.randrange(600))
+        return first.strftime("%Y-%m-%d %H:%M:%S"), last.strftime("%Y-%m-%d %H:%M:%S")
+
+    bssids = [randomMac(rnd, rnd.choice(OUIS)) for _ in range(aps)]
+    essids = [randomEssid(rnd, commaRate) for _ in range(max(1, aps * 2 // 3))]
+    lines = ["", AP_HEADER]
+    for bssid in bssids:
+        fts, lts = seen()
+        priv, cipher, auth = rnd.choice(PRIVACY)
+        essid = "" if rnd.random() < hiddenRate else rnd.choice(essids)
+        shown = f'"{essid}"' if "," in essid else essid
+        lines.append(f"{bssid}, {fts}, {lts}, {rnd.choice(CHANNELS):>2}, {rnd.choice(SPEEDS):>3}, {priv}, {cipher}, {auth:<3}, "
+                    f"{-rnd.randint(20, 90):>3}, {rnd.randrange(5000):>8}, {rnd.randrange(200):>8},   0.  0.  0.  0, "
+                    f"{len(essid):>3}, {shown}, ")
+
+    # Stations probe for ESSIDs they know, some of which are not around. Probe lists are comma
+    # separated with no quoting, so they never contain commas themselves.
+    probeable = [e for e in essids if "," not in e] + [randomEssid(rnd, 0) for _ in range(max(1, aps // 3))]
+    lines += ["", STATION_HEADER]
+    for i in range(stations):
+        fts, lts = seen()
+        if rnd.random() < meshRate:
+            # Mesh nodes show up in both tables
+            mac = rnd.choice(bssids)
+        else:
+            mac = randomMac(rnd, None if rnd.random() < 0.3 else rnd.choice(OUIS))
+        assoc = rnd.choice(bssids) if rnd.random() < assocRate else "(not associated) "
+        probes = rnd.sample(probeable, min(len(probeable), int(rnd.expovariate(1 / probeFanout)))) if probeFanout else []
+        lines.append(f"{mac}, {fts}, {lts}, {-rnd.randint(1, 90):>3}, {rnd.randrange(1, 500):>8}, {assoc},{','.join(probes)}")
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+def dataUrl(capture):
+    return "data:text/csv;base64," + base64.b64encode(capture).decode()
+
+class Timings:
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        # Stage output (progress prints) is swallowed so it does not skew the timings
+        entry = {'stage': name, 'seconds': None, 'items': items}
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            yield entry
+            entry['seconds'] = perf_counter() - start
+        if entry['items']:
+            entry['perSecond'] = entry['items'] / entry['seconds'] if entry['seconds'] else None
+        self.results.append(entry)
+        rate = f"{entry['perSecond']:>12.0f}/s" if entry.get('perSecond') else ""
+        print(f"{name:<28} {entry['seconds'] * 1000:>10.1f} ms {entry['items'] or '':>9} {rate}", file=sys.stderr)
+
+def gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def openHandler(backend, path):
+    handlerModule.config.read_dict({'storage': {'Backend': backend, 'Path': path},
+                                    # Keep the shared version file of a headless server out of it
+                                    'server': {'VersionFile': ''}})
+    cfg = handlerModule.config['neo4j']
+    with contextlib.redirect_stdout(io.StringIO()):
+        return handlerModule.neoHandler(cfg['Uri'], cfg['User'], cfg['Password'])
+
+def run(args):
+    timings = Timings()
+    capture = generateCapture(args.aps, args.stations, args.probes, args.mesh, seed=args.seed)
+    content = dataUrl(capture)
+
+    with timings.stage("parseUpload", args.aps + args.stations):
+        dType, (bssidNodes, stationNodes) = bg_parsers.parseUpload(content)
+
+    macs = [b['bssid'] for b in bssidNodes] + [s['bssid'] for _, s in stationNodes]
+    with timings.stage("macLookupMany", len(macs)):
+        bg_oui.macLookupMany(macs)
+    bg_oui.macLookup.cache_clear()
+    with timings.stage("macLookup (cold cache)", len(macs)):
+        for mac in macs:
+            bg_oui.macLookup(mac)
+
+    workdir = tempfile.mkdtemp(prefix="bg-bench-")
+    neo = openHandler(args.backend, os.path.join(workdir, "bench.bgdb"))
+    if args.backend == "neo4j":
+        with contextlib.redirect_stdout(io.StringIO()):
+            neo.deleteDB()
+
+    with timings.stage("insertAiroData", args.aps + args.stations):
+        neo.handleIncomingData(dType, [(bssidNodes, stationNodes)])
+        neo.store.flush()
+
+    with timings.stage("getCatalog (cold)") as t:
+        catalog = neo.getCatalog()
+        t['items'] = sum(len(values) for values in catalog.values())
+    with timings.stage("getDbStats (cold)"):
+        stats = neo.getDbStats()
+    with timings.stage("getDbStats (warm)"):
+        neo.getDbStats()
+
+    names = [value for value, _ in sorted(catalog['name'], key=lambda e: -e[1])[:20]]
+    channels = [value for value, _ in catalog['channel'][:1]]
+    searches = [("type WPA2", ["WPA2"], "type"), ("type Client", ["Client"], "type"),
+                ("name x20", names, "name"), ("channel", channels, "channel")]
+    for label, values, prop in searches:
+        for state in ("cold", "warm"):
+            with timings.stage(f"searchQuery {label} ({state})") as t:
+                elements = neo.searchQuery(values, prop)
+                t['items'] = len(elements['nodes']) + len(elements['edges'])
+
+    # dataToJSON on its own, over rows already pulled from the store
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = copy.deepcopy(list(neo.store.searchLabel("Device")))
+    with timings.stage("dataToJSON (all devices)", len(rows)):
+        neo.dataToJSON(rows)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {'revision': gitRevision(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(), 'platform': platform.platform(), 'backend': args.backend,
+                    'aps': args.aps, 'stations': args.stations, 'probeFanout': args.probes, 'meshRate': args.mesh,
+                    'seed': args.seed, 'captureBytes': len(capture), 'ouiDatabase': os.path.exists(bg_oui.OUI_SOURCE),
+                    'dbStats': dict(stats)},
+        'results': timings.results}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BeaconGraph end-to-end benchmark")
+    parser.add_argument("--aps", type=int, default=2000)
+    parser.add_argument("--stations", type=int, default=8000)
+    parser.add_argument("--probes", type=float, default=2.0, help="mean probed ESSIDs per station")
+    parser.add_argument("--mesh", type=float, default=0.01, help="share of stations that are also APs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", choices=["embedded", "neo4j"], default="embedded")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--write-capture", metavar="PATH", help="only write the generated capture to PATH")
+    args = parser.parse_args()
+
+    if args.write_capture:
+        with open(os.path.join(CWD, args.write_capture), "wb") as f:
+            f.write(generateCapture(args.aps, args.stations, args.probes, args.mesh, seed=args.seed))
+        sys.exit(0)
+
+    report = json.dumps(run(args), indent=2, default=str)
+    if args.output:
+        with open(os.path.join(CWD, args.output), "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
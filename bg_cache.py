@@ -0,0 +1,59 @@
+import json
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+    # LRU cache of search results, bounded by the size of their JSON encoding. Entries are keyed with
+    # the data version they were computed at, anything older is dropped once the version moves on.
+    # Results are stored encoded so callers can mutate what they get back (layout positions etc).
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.__entries = OrderedDict()
+        self.__version = None
+        self.__lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.__lock:
+            self.__checkVersion(version)
+            blob = self.__entries.get(key)
+            if blob is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(blob)
+
+    def put(self, key, version, result):
+        blob = json.dumps(result, default=str).encode()
+        if len(blob) > self.maxBytes:
+            return
+        with self.__lock:
+            self.__checkVersion(version)
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.__entries[key] = blob
+            self.bytes += len(blob)
+            while self.bytes > self.maxBytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def __checkVersion(self, version):
+        if version != self.__version:
+            self.invalidations += len(self.__entries)
+            self.__entries.clear()
+            self.bytes = 0
+            self.__version = version
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.__entries), 'bytes': self.bytes, 'maxBytes': self.maxBytes,
+                    'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
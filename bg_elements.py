@@ -0,0 +1,54 @@
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+class ElementHistory:
+    # Remembers the element sets recently sent to the browser, keyed by a version the browser echoes
+    # back, so a new search only ships what changed relative to the graph on screen.
+    # Versions carry the process id, a version handed out by another server worker is never
+    # mistaken for one of ours.
+    def __init__(self, keep=4):
+        self.keep = keep
+        self.__versions = OrderedDict()
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    def get(self, version):
+        with self.__lock:
+            return self.__versions.get(version)
+
+    def delta(self, baseVersion, elements, lockExisting=False):
+        # {'version', 'full', 'add': {nodes, edges}, 'remove': [ids], 'lockExisting'}
+        base = self.get(baseVersion)
+        with self.__lock:
+            version = f"{os.getpid()}-{next(self.__ids)}"
+            self.__versions[version] = elements
+            while len(self.__versions) > self.keep:
+                self.__versions.popitem(last=False)
+
+        # Cluster members in 'clusters' stay on the server
+        full = {'version': version, 'full': True, 'add': {'nodes': elements['nodes'], 'edges': elements['edges']},
+                'remove': [], 'lockExisting': False}
+        if base is None:
+            return full
+
+        add, remove = {'nodes': [], 'edges': []}, []
+        for group in ('nodes', 'edges'):
+            old = {ele['data']['id']: ele for ele in base.get(group, [])}
+            new = {ele['data']['id']: ele for ele in elements.get(group, [])}
+            for eid, ele in new.items():
+                previous = old.get(eid)
+                if previous is None:
+                    add[group].append(ele)
+                elif previous['data'] != ele['data'] or previous.get('position') != ele.get('position'):
+                    # Changed elements are replaced
+                    remove.append(eid)
+                    add[group].append(ele)
+            remove.extend(eid for eid in old if eid not in new)
+
+        if len(add['nodes']) + len(add['edges']) + len(remove) >= len(elements['nodes']) + len(elements['edges']):
+            return full
+
+        print(f"Element delta: +{len(add['nodes'])} nodes, +{len(add['edges'])} edges, -{len(remove)} removed")
+        return {'version': version, 'full': False, 'add': add, 'remove': remove, 'lockExisting': lockExisting}
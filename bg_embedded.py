@@ -0,0 +1,279 @@
+import json
+import os
+import threading
+import numpy as np
+from array import array
+from time import perf_counter
+import bg_presets
+from bg_store import GraphStore
+
+# In-process graph for a single analyst, no Neo4j server needed. Nodes are ids into parallel
+# label/property lists, relationships are three compact arrays (source, target, type) and
+# incident edges are found through CSR offsets built from them after each write. Every
+# searchable property has a value -> [node ids] index, the bssid one doubles as the uniqueness
+# constraint. The graph is saved to a single .npz file after each ingest.
+LABELS = bg_presets.AP_LABELS + ["Client"]
+RELATIONS = ["Probes", "AssociatedTo"]
+PROBES, ASSOCIATED = 0, 1
+INDEXED_PROPS = bg_presets.CATALOG_FIELDS
+AP_PROPS = ['bssid', 'name', 'oui', 'encryption', 'speed', 'channel', 'auth', 'cipher', 'lan']
+STATION_PROPS = {'FirstTimeSeen': 'fts', 'LastTimeSeen': 'lts', 'Power': 'pwr', 'NumPackets': 'pkts', 'Association': 'assoc'}
+FORMAT = 1
+
+def toString(value):
+    return None if value is None else str(value)
+
+class EmbeddedStore(GraphStore):
+    def __init__(self, path):
+        self.path = path
+        self.uri = f"embedded:{os.path.abspath(path)}"
+        self.__lock = threading.RLock()
+        self.__clear()
+        if os.path.exists(path):
+            start = perf_counter()
+            self.__load()
+            print(f"Loaded {len(self.labels)} nodes, {len(self.rel)} relationships from {path} in {perf_counter() - start:.2f}s")
+
+    def __clear(self):
+        self.labels = array('B')
+        self.props = []
+        self.src, self.dst, self.rel = array('q'), array('q'), array('B')
+        self.__edgeKeys = set()
+        self.__index = {prop: {} for prop in INDEXED_PROPS}
+        self.__byLabel = {label: [] for label in LABELS}
+        self.__csr = None
+        self.__dirty = False
+
+    def __addNode(self, label, props):
+        i = len(self.props)
+        props = {k: v for k, v in props.items() if v is not None}
+        self.labels.append(LABELS.index(label))
+        self.props.append(props)
+        self.__byLabel[label].append(i)
+        for prop in INDEXED_PROPS:
+            if prop in props:
+                self.__index[prop].setdefault(props[prop], []).append(i)
+        self.__csr = None
+        self.__dirty = True
+        return i
+
+    def __addEdge(self, source, target, rel):
+        key = (source, rel, target)
+        if key in self.__edgeKeys:
+            return 0
+        self.__edgeKeys.add(key)
+        self.src.append(source)
+        self.dst.append(target)
+        self.rel.append(rel)
+        self.__csr = None
+        self.__dirty = True
+        return 1
+
+    def __byBssid(self, bssid):
+        ids = self.__index['bssid'].get(bssid)
+        return ids[0] if ids else None
+
+    def mergeBssidNodes(self, label, rows):
+        created = 0
+        with self.__lock:
+            for row in rows:
+                if label == "AP" and any(LABELS[self.labels[i]] == "AP" for i in self.__index['name'].get(row['name'], ())):
+                    continue
+                i = self.__byBssid(row['bssid'])
+                if i is None:
+                    self.__addNode(label, {prop: row.get(prop) for prop in AP_PROPS})
+                    created += 1
+                elif LABELS[self.labels[i]] == "AP" and 'name' not in self.props[i]:
+                    self.__upgradeStub(i, label, {prop: row.get(prop) for prop in AP_PROPS})
+        return created, 0
+
+    def __upgradeStub(self, i, label, props):
+        # A nameless AP created by an association before the AP's own row was seen
+        self.__byLabel["AP"].remove(i)
+        self.__byLabel[label].append(i)
+        self.labels[i] = LABELS.index(label)
+        for prop, value in props.items():
+            if value is not None and prop not in self.props[i]:
+                self.props[i][prop] = value
+                if prop in INDEXED_PROPS:
+                    self.__index[prop].setdefault(value, []).append(i)
+        self.__dirty = True
+
+    def mergeStations(self, rows):
+        created = 0
+        with self.__lock:
+            for row in rows:
+                i = self.__byBssid(row['bssid'])
+                if i is None:
+                    i = self.__addNode("Client", {'bssid': row['bssid'], 'name': row.get('name'), 'oui': row.get('oui')})
+                    created += 1
+                props = self.props[i]
+                for prop, key in STATION_PROPS.items():
+                    if row.get(key) is None:
+                        props.pop(prop, None)
+                    else:
+                        props[prop] = row[key]
+                self.__dirty = True
+        return created, 0
+
+    def mergeProbedAPs(self, names):
+        created = 0
+        with self.__lock:
+            for name in names:
+                if name not in self.__index['name']:
+                    self.__addNode("AP", {'name': name})
+                    created += 1
+        return created, 0
+
+    def mergeProbes(self, rows):
+        edges = 0
+        with self.__lock:
+            for row in rows:
+                station, probed = self.__byBssid(row['station']), self.__index['name'].get(row['essid'])
+                if station is not None and probed:
+                    edges += self.__addEdge(station, probed[0], PROBES)
+        return 0, edges
+
+    def mergeAssociations(self, rows):
+        created = edges = 0
+        with self.__lock:
+            for row in rows:
+                station = self.__byBssid(row['station'])
+                if station is None:
+                    continue
+                ap = self.__byBssid(row['assoc'])
+                if ap is None:
+                    ap = self.__addNode("AP", {'bssid': row['assoc']})
+                    created += 1
+                edges += self.__addEdge(station, ap, ASSOCIATED)
+        return created, edges
+
+    def deleteAll(self):
+        with self.__lock:
+            self.__clear()
+            self.__dirty = True
+
+    def flush(self):
+        # Rewrites the whole file, so callers flush once per ingest job or watcher burst rather than
+        # per batch. Written to a temporary file first so a crash mid-save keeps the previous graph.
+        with self.__lock:
+            if not self.__dirty:
+                return
+            start = perf_counter()
+            tmp = self.path + ".tmp"
+            with open(tmp, 'wb') as f:
+                np.savez(f, format=np.array([FORMAT]), labels=np.frombuffer(self.labels, dtype=np.uint8).copy(),
+                            src=np.frombuffer(self.src, dtype=np.int64).copy(), dst=np.frombuffer(self.dst, dtype=np.int64).copy(),
+                            rel=np.frombuffer(self.rel, dtype=np.uint8).copy(),
+                            props=np.frombuffer(json.dumps(self.props).encode(), dtype=np.uint8))
+            os.replace(tmp, self.path)
+            self.__dirty = False
+        print(f"Saved {len(self.labels)} nodes, {len(self.rel)} relationships to {self.path} in {perf_counter() - start:.2f}s")
+
+    def __load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            if int(data['format'][0]) != FORMAT:
+                raise ValueError(f"{self.path}: unsupported embedded graph format {int(data['format'][0])}")
+            labels, props = data['labels'], json.loads(data['props'].tobytes().decode())
+            src, dst, rel = data['src'], data['dst'], data['rel']
+
+        # The indexes are cheaper to rebuild than to store
+        for label, p in zip(labels.tolist(), props):
+            self.__addNode(LABELS[label], p)
+        self.src.frombytes(src.astype(np.int64).tobytes())
+        self.dst.frombytes(dst.astype(np.int64).tobytes())
+        self.rel.frombytes(rel.astype(np.uint8).tobytes())
+        self.__edgeKeys = set(zip(src.tolist(), rel.tolist(), dst.tolist()))
+        self.__dirty = False
+
+    def __adjacency(self):
+        # (offsets, edge ids) per direction: the edges leaving node i are out[outOff[i]:outOff[i + 1]]
+        if self.__csr is None:
+            count = len(self.props)
+            src = np.frombuffer(self.src, dtype=np.int64).copy()
+            dst = np.frombuffer(self.dst, dtype=np.int64).copy()
+            csr = []
+            for ends in (src, dst):
+                offsets = np.zeros(count + 1, dtype=np.int64)
+                np.cumsum(np.bincount(ends, minlength=count), out=offsets[1:])
+                csr.append((offsets, np.argsort(ends, kind='stable')))
+            self.__csr = csr
+        return self.__csr
+
+    def __clientMap(self, i):
+        p = self.props[i]
+        return {'id': i, 'name': p.get('name'), 'type': [LABELS[self.labels[i]], "Device"], 'bssid': p.get('bssid'),
+                'oui': p.get('oui'), 'fts': p.get('fts'), 'lts': p.get('lts'), 'pwr': toString(p.get('pwr'))}
+
+    def __apMap(self, i):
+        p = self.props[i]
+        return {'id': i, 'name': p.get('name'), 'type': [LABELS[self.labels[i]], "Device"], 'oui': p.get('oui'),
+                'bssid': p.get('bssid'), 'channel': toString(p.get('channel')), 'speed': toString(p.get('speed')),
+                'auth': p.get('auth'), 'cipher': p.get('cipher'), 'lan': p.get('lan')}
+
+    def __edgeRow(self, e):
+        a, b, name = self.src[e], self.dst[e], RELATIONS[self.rel[e]]
+        return {'a': self.__clientMap(a), 'b': self.__apMap(b),
+                'edge': {'id': f"{a}-{name}-{b}", 'source': a, 'target': b, 'name': name}}
+
+    def __searchRows(self, ids):
+        # Same rows as bg_presets.__searchQuery: one per relationship touching a matched node,
+        # matched nodes without any come back with only b set
+        rows = []
+        with self.__lock:
+            (outOff, out), (inOff, inc) = self.__adjacency()
+            for m in ids:
+                edges = [int(e) for e in out[outOff[m]:outOff[m + 1]]]
+                edges += [int(e) for e in inc[inOff[m]:inOff[m + 1]] if self.src[e] != m]
+                if not edges:
+                    rows.append({'a': None, 'b': self.__apMap(m), 'edge': None})
+                rows.extend(self.__edgeRow(e) for e in edges)
+        return iter(rows)
+
+    def initial(self):
+        with self.__lock:
+            return iter([self.__edgeRow(e) for e in range(min(100, len(self.rel)))])
+
+    def searchNodes(self, prop, values):
+        with self.__lock:
+            index = self.__index[prop]
+            ids = dict.fromkeys(i for value in values for i in index.get(value, ()))
+        return self.__searchRows(ids)
+
+    def searchLabel(self, label):
+        with self.__lock:
+            ids = range(len(self.props)) if label == "Device" else list(self.__byLabel[label])
+        return self.__searchRows(ids)
+
+    def searchIds(self, ids):
+        with self.__lock:
+            count = len(self.props)
+        return self.__searchRows([i for i in dict.fromkeys(int(i) for i in ids) if 0 <= i < count])
+
+    def catalog(self):
+        rows = []
+        with self.__lock:
+            for prop in bg_presets.CATALOG_FIELDS:
+                rows.extend((prop, value, len(ids)) for value, ids in self.__index[prop].items())
+            rows.extend(('type', label, len(ids)) for label, ids in self.__byLabel.items() if ids)
+            if self.props:
+                rows.append(('type', "Device", len(self.props)))
+        return rows
+
+    def stats(self):
+        with self.__lock:
+            counts = np.bincount(np.frombuffer(self.rel, dtype=np.uint8), minlength=len(RELATIONS)) if len(self.rel) else [0] * len(RELATIONS)
+            rows = [(label, len(self.__byLabel[label])) for label in bg_presets.STATS_LABELS]
+        rows += [(name, int(counts[RELATIONS.index(rel)])) for name, rel in bg_presets.STATS_RELATIONS.items()]
+        return rows
+
+    def indexStatus(self):
+        return [(f"INDEX ON :Device({prop})", "ONLINE", 100.0) for prop in INDEXED_PROPS]
+
+    def profilePresets(self, catalog):
+        with self.__lock:
+            return "\n".join(f"== {prop}: {len(self.__index[prop])} distinct values" for prop in INDEXED_PROPS)
+
+    def summary(self):
+        with self.__lock:
+            return f"in process, {len(self.props)} nodes, {len(self.rel)} relationships"
@@ -0,0 +1,136 @@
+import itertools
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from time import perf_counter
+import bg_parsers
+
+class IngestCancelled(Exception):
+    pass
+
+class IngestJob:
+    def __init__(self, jobId, contents, names, cancels=None):
+        # cancels reads the shared count of Cancel Upload clicks, one made in any server worker
+        # after the job was submitted cancels it
+        self.id = jobId
+        self.cancels = cancels
+        self.cancelsSeen = cancels() if cancels else None
+        self.contents = contents
+        self.names = names or [f"upload {i}" for i in range(len(contents))]
+        self.state = "queued"
+        self.rowsParsed = 0
+        self.nodesWritten = 0
+        self.edgesWritten = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.cancelEvent = threading.Event()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def checkCancelled(self):
+        if self.cancelEvent.is_set() or (self.cancels and self.cancels() != self.cancelsSeen):
+            raise IngestCancelled()
+
+    def written(self, nodes, edges):
+        self.nodesWritten += nodes
+        self.edgesWritten += edges
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or perf_counter()) - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.rowsParsed / elapsed if elapsed else 0.0
+
+    def status(self):
+        files = ", ".join(self.names)
+        line = f"#{self.id} {self.state.upper()} [{files}]"
+        if self.started is not None:
+            line += (f"\n   {self.rowsParsed} rows, {self.nodesWritten} nodes, {self.edgesWritten} edges"
+                    f" | {self.rate():.0f} rows/s | {self.elapsed():.1f}s")
+        if self.error:
+            line += f"\n   {self.error}"
+        return line
+
+class IngestQueue:
+    def __init__(self, neo, workers=0, history=5):
+        self.neo = neo
+        self.workers = workers
+        self.history = history
+        self.jobs = OrderedDict()
+        self.completed = 0
+        self.__ids = itertools.count(1)
+        self.__queue = queue.Queue()
+        self.__lock = threading.Lock()
+
+        thread = threading.Thread(target=self.__run, name="ingest-worker")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, contents, names=None):
+        with self.__lock:
+            job = IngestJob(next(self.__ids), contents, names, lambda: self.neo.versions.get('cancels'))
+            self.jobs[job.id] = job
+            # Only keep the most recent jobs around for the status panel
+            while len(self.jobs) > self.history and next(iter(self.jobs.values())).finished:
+                self.jobs.popitem(last=False)
+
+        self.__queue.put(job)
+        return job.id
+
+    def cancel(self, jobId=None):
+        # Without a job id every unfinished upload is cancelled, including those queued in the
+        # other workers of a headless server
+        with self.__lock:
+            jobs = [self.jobs[jobId]] if jobId in self.jobs else list(self.jobs.values())
+        if jobId not in self.jobs:
+            self.neo.versions.bump('cancels')
+        for job in jobs:
+            if job.finished is None:
+                job.cancel()
+
+    def active(self):
+        with self.__lock:
+            return any(job.finished is None for job in self.jobs.values())
+
+    def status(self):
+        with self.__lock:
+            jobs = list(self.jobs.values())
+        if not jobs:
+            return "No uploads yet."
+        return "\n".join(job.status() for job in reversed(jobs))
+
+    def __run(self):
+        while True:
+            job = self.__queue.get()
+            job.state = "running"
+            job.started = perf_counter()
+            try:
+                job.checkCancelled()
+                for dType, nodes in bg_parsers.parseUploads(job.contents, job.names, self.workers):
+                    job.checkCancelled()
+                    job.rowsParsed += sum(len(n) for n in nodes)
+                    self.neo.handleIncomingData(dType, [nodes], job)
+                job.state = "done"
+            except IngestCancelled:
+                job.state = "cancelled"
+            except Exception as e:
+                traceback.print_exc()
+                job.state = "failed"
+                job.error = str(e)
+            finally:
+                # Drop the upload payload, it can be hundreds of MB
+                job.contents = None
+                try:
+                    self.neo.store.flush()
+                except Exception:
+                    traceback.print_exc()
+                self.neo.dataSettled()
+                job.finished = perf_counter()
+                self.completed += 1
+                print(job.status())
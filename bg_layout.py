@@ -0,0 +1,140 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from time import perf_counter
+
+# Force-directed layout computed on the server so the browser only has to draw a 'preset' layout.
+# Repulsion is exact below EXACT_MAX nodes and approximated Barnes-Hut style above it, by
+# treating every occupied grid cell as one body at its centre of mass.
+EXACT_MAX = 300
+MAX_CELLS = 12
+IDEAL_EDGE = 100.0
+
+def forceLayout(count, edges, initial=None, pinned=None, iterations=None, seed=0, fixed=None):
+    # count nodes, edges as an (m, 2) index array, initial (count, 2) positions or None.
+    # pinned nodes (seen in an earlier search) only drift a little, fixed nodes (still on screen)
+    # do not move at all.
+    rnd = np.random.RandomState(seed)
+    k = IDEAL_EDGE
+    spread = k * np.sqrt(max(count, 1))
+    pos = rnd.uniform(-spread / 2, spread / 2, (count, 2)) if initial is None else np.array(initial, dtype=float)
+    weight = np.ones(count) if pinned is None else np.where(pinned, 0.1, 1.0)
+    if fixed is not None:
+        weight = np.where(fixed, 0.0, weight)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    temperature = spread / 10
+    if iterations is None:
+        iterations = 60 if count <= EXACT_MAX else 30
+
+    for _ in range(iterations):
+        disp = __repulsion(pos, k)
+
+        if len(edges):
+            delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+            dist = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01)[:, None]
+            pull = delta * dist / k
+            for d in (0, 1):
+                disp[:, d] += np.bincount(edges[:, 1], pull[:, d], count) - np.bincount(edges[:, 0], pull[:, d], count)
+
+        length = np.maximum(np.hypot(disp[:, 0], disp[:, 1]), 0.01)[:, None]
+        pos += disp / length * np.minimum(length, temperature) * weight[:, None]
+        temperature *= 0.95
+
+    return pos
+
+def __repulsion(pos, k):
+    count = len(pos)
+    disp = np.zeros_like(pos)
+    if count < 2:
+        return disp
+
+    if count <= EXACT_MAX:
+        dx = pos[:, 0, None] - pos[None, :, 0]
+        dy = pos[:, 1, None] - pos[None, :, 1]
+        force = k * k / np.maximum(dx * dx + dy * dy, 0.01)
+        np.fill_diagonal(force, 0.0)
+        disp[:, 0] = (dx * force).sum(axis=1)
+        disp[:, 1] = (dy * force).sum(axis=1)
+        return disp
+
+    # Bin nodes into at most MAX_CELLS x MAX_CELLS cells and repel from the cell centres of mass
+    cells = min(MAX_CELLS, int(np.sqrt(count)) // 4 + 1)
+    lo, hi = pos.min(axis=0), pos.max(axis=0)
+    idx = np.minimum(((pos - lo) / np.maximum(hi - lo, 1e-9) * cells).astype(np.int64), cells - 1)
+    cell = idx[:, 0] * cells + idx[:, 1]
+    mass = np.bincount(cell, minlength=cells * cells).astype(float)
+    occupied = mass > 0
+    cx = np.bincount(cell, pos[:, 0], cells * cells)[occupied] / mass[occupied]
+    cy = np.bincount(cell, pos[:, 1], cells * cells)[occupied] / mass[occupied]
+    mass = mass[occupied]
+
+    for start in range(0, count, 4096):
+        chunk = pos[start:start + 4096]
+        dx = chunk[:, 0, None] - cx[None, :]
+        dy = chunk[:, 1, None] - cy[None, :]
+        force = k * k * mass / np.maximum(dx * dx + dy * dy, k * k)
+        disp[start:start + 4096, 0] = (dx * force).sum(axis=1)
+        disp[start:start + 4096, 1] = (dy * force).sum(axis=1)
+    return disp
+
+class LayoutCache:
+    # Remembers node coordinates across searches so the picture stays stable
+    def __init__(self, maxNodes=200000, iterations=None):
+        self.maxNodes = maxNodes
+        self.iterations = iterations
+        self.positions = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def apply(self, elements, fixed=None):
+        # fixed: ids of nodes already on screen, they keep their cached position
+        nodes, edges = elements.get('nodes', []), elements.get('edges', [])
+        if not nodes:
+            return elements
+
+        start = perf_counter()
+        index = {node['data']['id']: i for i, node in enumerate(nodes)}
+        pairs = [(index[e['data']['source']], index[e['data']['target']]) for e in edges
+                    if e['data']['source'] in index and e['data']['target'] in index]
+
+        with self.__lock:
+            cached = [self.positions.get(node['data']['id']) for node in nodes]
+        pinned = np.array([c is not None for c in cached])
+        fixed = np.array([c is not None and node['data']['id'] in fixed for node, c in zip(nodes, cached)]) if fixed else None
+        initial = self.__initialPositions(cached, pairs)
+
+        # Mostly known nodes only need a short settle for the new ones
+        iterations = self.iterations or (15 if pinned.mean() > 0.8 else None)
+        if fixed is not None and fixed.all():
+            pos = initial
+        else:
+            pos = forceLayout(len(nodes), pairs, initial, pinned, iterations, fixed=fixed)
+
+        with self.__lock:
+            for node, (x, y) in zip(nodes, pos):
+                node['position'] = {'x': float(x), 'y': float(y)}
+                self.positions[node['data']['id']] = (float(x), float(y))
+                self.positions.move_to_end(node['data']['id'])
+            while len(self.positions) > self.maxNodes:
+                self.positions.popitem(last=False)
+
+        print(f"Server layout of {len(nodes)} nodes, {len(pairs)} edges took {perf_counter() - start:.2f}s "
+                f"({int(pinned.sum())} cached)")
+        return elements
+
+    def __initialPositions(self, cached, pairs):
+        # New nodes start next to an already placed neighbour when there is one
+        count = len(cached)
+        rnd = np.random.RandomState(count)
+        spread = IDEAL_EDGE * np.sqrt(count)
+        pos = rnd.uniform(-spread / 2, spread / 2, (count, 2))
+        known = np.zeros(count, dtype=bool)
+        for i, c in enumerate(cached):
+            if c is not None:
+                pos[i], known[i] = c, True
+
+        for a, b in pairs:
+            if known[a] and not known[b]:
+                pos[b], known[b] = pos[a] + rnd.uniform(-IDEAL_EDGE, IDEAL_EDGE, 2), True
+            elif known[b] and not known[a]:
+                pos[a], known[a] = pos[b] + rnd.uniform(-IDEAL_EDGE, IDEAL_EDGE, 2), True
+        return pos
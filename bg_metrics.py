@@ -0,0 +1,267 @@
+import cProfile
+import functools
+import io
+import pstats
+import threading
+from time import perf_counter
+
+# Process wide timing histograms in the Prometheus text format, served on /metrics. Under the
+# headless server every worker process keeps and serves its own.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def __escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatLabels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{__escape(v)}"' for k, v in pairs) + "}"
+
+class Histogram:
+    def __init__(self, name, help, labelNames, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.series = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelNames)
+        with self.__lock:
+            counts, total = self.series.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.series[key] = (counts, total + value)
+
+    def snapshot(self):
+        # {labels: (per bucket counts, sum, count)}
+        with self.__lock:
+            return {key: (list(counts), total, sum(counts)) for key, (counts, total) in self.series.items()}
+
+    def quantile(self, counts, q):
+        # Upper bound of the bucket holding the q-th observation, like histogram_quantile without interpolation
+        target, seen = q * sum(counts), 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{formatLabels(key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{formatLabels(key, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{formatLabels(key)} {total}")
+            lines.append(f"{self.name}_count{formatLabels(key)} {count}")
+        return lines
+
+class Gauges:
+    # Values read at scrape time, read() returns [(labels dict, value)]
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.read():
+            lines.append(f"{self.name}{formatLabels(sorted(labels.items()))} {value}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, labelNames, buckets=SECONDS_BUCKETS):
+        metric = Histogram(name, help, labelNames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauges(self, name, help, read):
+        metric = Gauges(name, help, read)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+DB_SECONDS = REGISTRY.histogram('beacongraph_db_seconds', "Time in storage backend calls, row streams until exhausted", ['query'])
+# Reported by Neo4j in the result summary, so network time is not included. A plan cache hit shows
+# up as a drop in the time until the first record was available.
+DB_SERVER_AVAILABLE_SECONDS = REGISTRY.histogram('beacongraph_db_server_available_seconds',
+                        "Neo4j result_available_after: planning and execution until the first record", ['query'])
+DB_SERVER_CONSUMED_SECONDS = REGISTRY.histogram('beacongraph_db_server_consumed_seconds',
+                        "Neo4j result_consumed_after: from the first record until the last was consumed", ['query'])
+DB_ROWS = REGISTRY.histogram('beacongraph_db_rows', "Rows returned or written per storage backend call", ['query'], ROWS_BUCKETS)
+CALLBACK_SECONDS = REGISTRY.histogram('beacongraph_callback_seconds', "Time in Dash callback functions", ['callback', 'status'])
+REQUEST_SECONDS = REGISTRY.histogram('beacongraph_update_seconds', "Dash update requests including serialization", ['output'])
+RESPONSE_BYTES = REGISTRY.histogram('beacongraph_update_bytes', "Serialized Dash update response size", ['output'], BYTES_BUCKETS)
+
+class Profiler:
+    # Opt-in cProfile capture of the next call of one callback
+    def __init__(self):
+        self.armed = None
+        self.report = ""
+        self.__lock = threading.Lock()
+
+    def arm(self, name):
+        with self.__lock:
+            self.armed = name
+
+    def take(self, name):
+        with self.__lock:
+            if self.armed != name:
+                return False
+            self.armed = None
+            return True
+
+    def run(self, name, fn, *args):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args)
+        finally:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(30)
+            self.report = f"{name}\n{out.getvalue()}"
+
+PROFILER = Profiler()
+
+def timedCallback(fn):
+    # Goes under @app.callback(...), PreventUpdate is counted separately from real updates.
+    # Dash is only imported here so neoHandler and the benchmarks load without it.
+    from dash.exceptions import PreventUpdate
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        start, status = perf_counter(), "ok"
+        try:
+            if PROFILER.take(name):
+                return PROFILER.run(name, fn, *args)
+            return fn(*args)
+        except PreventUpdate:
+            status = "prevented"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            CALLBACK_SECONDS.observe(perf_counter() - start, callback=name, status=status)
+
+    return wrapper
+
+class InstrumentedStore:
+    # Wraps a GraphStore so every call into the backend is timed. Row generators are timed
+    # until they are exhausted, writes count the rows they were given.
+    TIMED = {'mergeBssidNodes', 'mergeStations', 'mergeProbedAPs', 'mergeProbes', 'mergeAssociations', 'flush',
+                'catalog', 'stats', 'initial', 'searchNodes', 'searchLabel', 'searchIds', 'deleteAll', 'indexStatus'}
+    # Calls whose first argument picks the preset
+    NAMED = {'mergeBssidNodes', 'searchNodes', 'searchLabel'}
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if name not in self.TIMED:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args):
+            query = f"{name}({args[0]})" if name in self.NAMED else name
+            start = perf_counter()
+            result = attr(*args)
+            if hasattr(result, '__next__'):
+                return self.__timedRows(query, result, start)
+            rows = len(args[-1]) if name.startswith('merge') else len(result) if isinstance(result, list) else None
+            self.__observe(query, start, rows)
+            return result
+
+        return call
+
+    def __timedRows(self, query, rows, start):
+        count = 0
+        for row in rows:
+            count += 1
+            yield row
+        self.__observe(query, start, count)
+
+    @staticmethod
+    def __observe(query, start, rows):
+        DB_SECONDS.observe(perf_counter() - start, query=query)
+        if rows is not None:
+            DB_ROWS.observe(rows, query=query)
+
+def observeServerTimes(query, availableMs, consumedMs):
+    # Neo4jStore row streams, from the summary of the exhausted cursor
+    if availableMs is not None:
+        DB_SERVER_AVAILABLE_SECONDS.observe(availableMs / 1000, query=query)
+    if consumedMs is not None:
+        DB_SERVER_CONSUMED_SECONDS.observe(consumedMs / 1000, query=query)
+
+def register(server):
+    # /metrics for Prometheus, plus the time and size of every Dash update request. Registered
+    # after Flask-Compress, so after_request sees the uncompressed JSON.
+    from flask import Response, g, request
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @server.before_request
+    def startUpdate():
+        if request.path.endswith('_dash-update-component'):
+            g.updateStart = perf_counter()
+
+    @server.after_request
+    def finishUpdate(response):
+        start = g.pop('updateStart', None)
+        if start is not None:
+            output = (request.get_json(silent=True) or {}).get('output', "")
+            REQUEST_SECONDS.observe(perf_counter() - start, output=output)
+            if not response.direct_passthrough:
+                RESPONSE_BYTES.observe(len(response.get_data()), output=output)
+        return response
+
+def summary():
+    # Text for the Settings tab: per callback and per query averages and p95
+    lines = [f"{'callback':<24} {'calls':>6} {'avg ms':>8} {'p95 ms':>8}"]
+    for key, (counts, total, count) in sorted(CALLBACK_SECONDS.snapshot().items()):
+        labels = dict(key)
+        name = labels['callback'] + ("" if labels['status'] == "ok" else f" ({labels['status']})")
+        lines.append(f"{name:<24} {count:>6} {total / count * 1000:>8.1f} {CALLBACK_SECONDS.quantile(counts, 0.95) * 1000:>8.0f}")
+
+    updates = {dict(key)['output']: (total, count) for key, (_, total, count) in RESPONSE_BYTES.snapshot().items()}
+    lines += ["", f"{'update':<24} {'calls':>6} {'avg ms':>8} {'avg KB':>8}"]
+    for key, (counts, total, count) in sorted(REQUEST_SECONDS.snapshot().items()):
+        output = dict(key)['output']
+        size, sized = updates.get(output, (0, 0))
+        lines.append(f"{output:<24} {count:>6} {total / count * 1000:>8.1f} {size / sized / 1024 if sized else 0:>8.1f}")
+
+    rows = {dict(key)['query']: (total, count) for key, (_, total, count) in DB_ROWS.snapshot().items()}
+    available = {dict(key)['query']: (total, count) for key, (_, total, count) in DB_SERVER_AVAILABLE_SECONDS.snapshot().items()}
+    consumed = {dict(key)['query']: (total, count) for key, (_, total, count) in DB_SERVER_CONSUMED_SECONDS.snapshot().items()}
+    average = lambda totals, query: (f"{totals[query][0] / totals[query][1] * 1000:>9.1f}" if query in totals else f"{'-':>9}")
+    lines += ["", f"{'query':<24} {'calls':>6} {'avg ms':>8} {'p95 ms':>8} {'server 1st':>10} {'server rest':>11} {'avg rows':>9}"]
+    for key, (counts, total, count) in sorted(DB_SECONDS.snapshot().items()):
+        query = dict(key)['query']
+        rowTotal, rowCount = rows.get(query, (0, 0))
+        lines.append(f"{query:<24} {count:>6} {total / count * 1000:>8.1f} {DB_SECONDS.quantile(counts, 0.95) * 1000:>8.0f} "
+                    f"{average(available, query):>10} {average(consumed, query):>11} {rowTotal / rowCount if rowCount else 0:>9.0f}")
+    return "\n".join(lines)
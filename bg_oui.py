@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from time import perf_counter
+
+OUI_SOURCE = "macaddress.io-db.json"
+CACHE_DIR = ".oui-cache"
+CACHE_VERSION = 1
+
+# Keys are (prefix << 8) | prefixBits, so MA-L/MA-M/MA-S blocks (24/28/36 bit) share one sorted array
+__keys = None
+__vendorIdx = None
+__vendors = None
+__lock = threading.Lock()
+
+def __sourceStamp(source):
+    st = os.stat(source)
+    return {'version': CACHE_VERSION, 'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+def __cachePaths():
+    return (os.path.join(CACHE_DIR, "meta.json"), os.path.join(CACHE_DIR, "keys.npy"),
+            os.path.join(CACHE_DIR, "vendoridx.npy"), os.path.join(CACHE_DIR, "vendors.txt"))
+
+def __buildCache(source, stamp):
+    seen, vendorTable, vendorIds = {}, [], {}
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            prefix = entry['oui'].replace(":", "").replace("-", "").upper()
+            if not 0 < len(prefix) <= 12:
+                continue
+            key = (int(prefix, 16) << 8) | (len(prefix) * 4)
+            if key in seen:
+                continue
+            vendor = " ".join(entry.get('companyName', "").split())
+            if vendor not in vendorIds:
+                vendorIds[vendor] = len(vendorTable)
+                vendorTable.append(vendor)
+            seen[key] = vendorIds[vendor]
+
+    keys = np.fromiter(seen.keys(), dtype=np.uint64, count=len(seen))
+    vendorIdx = np.fromiter(seen.values(), dtype=np.uint32, count=len(seen))
+    order = np.argsort(keys)
+    keys, vendorIdx = keys[order], vendorIdx[order]
+
+    metaPath, keysPath, idxPath, vendorsPath = __cachePaths()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    np.save(keysPath, keys)
+    np.save(idxPath, vendorIdx)
+    with open(vendorsPath, "w", encoding="utf-8") as f:
+        f.write("\n".join(vendorTable))
+    # Written last so a partially built cache is never picked up
+    with open(metaPath, "w") as f:
+        json.dump(stamp, f)
+
+    return keys, vendorIdx, vendorTable
+
+def __readCache(stamp):
+    metaPath, keysPath, idxPath, vendorsPath = __cachePaths()
+    try:
+        with open(metaPath) as f:
+            if json.load(f) != stamp:
+                return None
+        keys = np.load(keysPath, mmap_mode='r')
+        vendorIdx = np.load(idxPath, mmap_mode='r')
+        with open(vendorsPath, encoding="utf-8") as f:
+            vendorTable = f.read().split("\n")
+    except (OSError, ValueError):
+        return None
+
+    return keys, vendorIdx, vendorTable
+
+def __load():
+    global __keys, __vendorIdx, __vendors
+    with __lock:
+        if __keys is not None:
+            return
+
+        start = perf_counter()
+        if not os.path.exists(OUI_SOURCE):
+            print(f"{OUI_SOURCE} not found, OUI lookups disabled!")
+            __keys, __vendorIdx, __vendors = np.zeros(0, np.uint64), np.zeros(0, np.uint32), []
+            return
+
+        stamp = __sourceStamp(OUI_SOURCE)
+        cached = __readCache(stamp)
+        origin = "cache"
+        if cached is None:
+            cached = __buildCache(OUI_SOURCE, stamp)
+            origin = OUI_SOURCE
+
+        __keys, __vendorIdx, __vendors = cached
+        print(f"OUI database loaded from {origin}: {len(__keys)} prefixes, {len(__vendors)} vendors "
+                f"in {(perf_counter() - start) * 1000:.1f} ms (max RSS {maxRSS():.1f} MB)")
+
+def maxRSS():
+    # ru_maxrss is KB on Linux. The resource module only exists on Unix.
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def __macToInt(mac):
+    try:
+        value = mac.replace(":", "").replace("-", "")
+        return int(value, 16) if len(value) == 12 else -1
+    except (AttributeError, ValueError):
+        return -1
+
+def __resolve(macInts):
+    # Longest-prefix match for an array of 48-bit MACs, -1 marks invalid entries
+    __load()
+    result = np.full(len(macInts), -1, dtype=np.int64)
+    if len(__keys) == 0 or len(macInts) == 0:
+        return result
+
+    valid = macInts >= 0
+    macs = macInts.clip(min=0).astype(np.uint64)
+    for bits in (36, 28, 24):
+        pending = valid & (result < 0)
+        if not pending.any():
+            break
+        keys = ((macs >> np.uint64(48 - bits)) << np.uint64(8)) | np.uint64(bits)
+        pos = np.searchsorted(__keys, keys).clip(max=len(__keys) - 1)
+        hit = pending & (__keys[pos] == keys)
+        result[hit] = __vendorIdx[pos[hit]]
+
+    return result
+
+@lru_cache(maxsize=65536)
+def macLookup(mac):
+    idx = __resolve(np.array([__macToInt(mac)], dtype=np.int64))[0]
+    return __vendors[idx] if idx >= 0 else ""
+
+def macLookupMany(macs):
+    # Resolve a whole MAC column at once. Each distinct MAC is converted a single time.
+    macs = pd.Series(macs, dtype=object).fillna("").astype(str).str.upper()
+    unique = macs.unique()
+    idx = __resolve(np.fromiter((__macToInt(m) for m in unique), dtype=np.int64, count=len(unique)))
+    vendors = [__vendors[i] if i >= 0 else "" for i in idx]
+
+    return macs.map(dict(zip(unique, vendors))).tolist()
+
+if __name__ == '__main__':
+    # Report load time and memory for the OUI database: python bg_oui.py
+    print(f"Before load: max RSS {maxRSS():.1f} MB")
+    start = perf_counter()
+    print(macLookup("00:00:0C:00:00:00") or "-")
+    print(f"First lookup took {(perf_counter() - start) * 1000:.1f} ms, max RSS {maxRSS():.1f} MB")
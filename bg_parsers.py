@@ -1,81 +1,287 @@
 import base64
-import io
+import csv
 import json
-import pandas as pd
 import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from urllib.request import pathname2url
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from bg_oui import macLookupMany
 
 logging.basicConfig(format='%(asctime)s - %(message)s')
-macFrame = pd.DataFrame([json.loads(line) for line in open("macaddress.io-db.json").readlines()])
+
+AIRODUMP_HEADER = b'BSSID, First time seen, Last time seen, channel'
+SQLITE_HEADER = b'SQLite format 3\x00'
+CHUNK_ROWS = 5000
+BLOCK_SIZE = 4 * 65536
+INT_COLUMNS = {'channel', 'Speed', 'Power', '# beacons', '# IV', 'ID-length', '# packets'}
 
 def parseUpload(content):
-    content_type, content_string = content.split(',')
-    decoded = base64.b64decode(content_string)
-    if decoded.startswith(b'\r\nBSSID, First time seen, Last time seen, channel'):
-        print("Airodump received!")
-        bDict, sDict = __parseAirodump(decoded)
-        return "Airodump", __makeAirodumpNodes(bDict, sDict)
+    dType, bssidNodes, stationNodes = "", [], []
+    for dType, (bNodes, sNodes) in streamUpload(content):
+        bssidNodes.extend(bNodes)
+        stationNodes.extend(sNodes)
+
+    if dType:
+        return dType, (bssidNodes, stationNodes)
     
     return ""
 
-def macLookup(bssid):
-    for x in range(16, 7, -1):
-        if bssid[x] == ":":
-            pass
+def parseUploads(contents, names=None, workers=0):
+    # A single capture is streamed chunk by chunk. Several captures are parsed in a process pool
+    # and merged into one deduplicated batch per data type.
+    names = names or [f"upload {i}" for i in range(len(contents))]
+    if len(contents) == 1:
+        start = perf_counter()
+        yield from streamUpload(contents[0])
+        print(f"Parsed {names[0]} in {perf_counter() - start:.2f}s")
+        return
 
-        m = macFrame.loc[macFrame['oui'] == bssid[:x]]
-        if not m.empty:
-            return m['companyName'].values[0]
+    results = {}
+    # Never forked: this runs on the ingest thread next to Flask, Qt and pool threads whose locks
+    # a forked child could inherit held
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(contents)),
+                            mp_context=multiprocessing.get_context(method)) as pool:
+        for name, (parsed, elapsed) in zip(names, pool.map(__parseTimed, contents)):
+            print(f"Parsed {name} in {elapsed:.2f}s")
+            if parsed:
+                results.setdefault(parsed[0], []).append(parsed[1])
 
-    return ""
+    for dType, parsed in results.items():
+        if dType in ("Airodump", "Kismet"):
+            yield dType, __mergeAirodump(parsed)
 
-def __cleanup(data, station=False):
-    # Airodump format is dirty. Clean up for proper parsing.
-    cleanList = []
-    lines = data.split("\n")
-    headers = list(map(str.strip, lines[0].split(",")))
+def __parseTimed(content):
+    start = perf_counter()
+    parsed = parseUpload(content)
+    return parsed, perf_counter() - start
 
-    cleanList.append(",".join(headers))
+def __mergeAirodump(parsed):
+    # First sighting of an AP wins, like the ingest itself. Stations keep the widest time window,
+    # the power/packets/association of their latest sighting and every probed ESSID.
+    bssids, stations = {}, {}
+    for bssidNodes, stationNodes in parsed:
+        for b in bssidNodes:
+            bssids.setdefault(b['bssid'], b)
+        for essids, s in stationNodes:
+            if s['bssid'] not in stations:
+                stations[s['bssid']] = [list(essids), dict(s)]
+                continue
+            oldEssids, old = stations[s['bssid']]
+            oldEssids.extend(e for e in essids if e not in oldEssids)
+            fts, assoc = min(old['fts'], s['fts']), old['assoc']
+            if s['lts'] >= old['lts']:
+                old.update(s)
+            old['fts'] = fts
+            old['assoc'] = old['assoc'] or assoc
 
-    for line in lines[1:]:
-        items = list(map(str.strip, line.split(",")))
+    print(f"Merged {len(bssids)} BSSID and {len(stations)} station nodes!")
+    return list(bssids.values()), list(stations.values())
 
-        # Airodump uses commas in strings in CSV. Replace "," for list of items with |
-        if station:
-            essids = "|" + ",".join(items[6:]) + "|"
-            newList = [item for item in items if item not in items[6:]]
-            newList.append(essids)
-            cleanList.append(",".join(newList))
-        else:
-            cleanList.append(",".join(items))
+def streamUpload(content, chunkRows=CHUNK_ROWS):
+    # Decode a dcc.Upload data URL block by block and yield node chunks
+    content_type, content_string = content.split(',')
+    blocks = (base64.b64decode(content_string[i:i + BLOCK_SIZE]) for i in range(0, len(content_string), BLOCK_SIZE))
+    yield from __streamBlocks(blocks, chunkRows)
+
+def streamFile(path, chunkRows=CHUNK_ROWS):
+    # Same as streamUpload, reading a capture from disk. Kismet logs are queried in place.
+    with open(path, "rb") as f:
+        kismet = f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    if kismet:
+        yield from __streamKismet(path, chunkRows)
+        return
+
+    def blocks():
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                yield block
+
+    yield from __streamBlocks(blocks(), chunkRows)
+
+def __streamBlocks(blocks, chunkRows):
+    blocks = iter(blocks)
+    first = next(blocks, b"")
+    if first.lstrip(b"\r\n").startswith(AIRODUMP_HEADER):
+        print("Airodump received!")
+        for section, records in __iterAirodump(__lines(first, blocks), chunkRows):
+            if section == "Station":
+                yield "Airodump", __makeAirodumpNodes([], records)
+            else:
+                yield "Airodump", __makeAirodumpNodes(records, [])
+    elif first.startswith(SQLITE_HEADER):
+        # sqlite3 can only open files, the upload is spooled to disk block by block
+        with tempfile.TemporaryDirectory(prefix="bg-kismet-") as tmp:
+            path = os.path.join(tmp, "upload.kismet")
+            with open(path, "wb") as f:
+                f.write(first)
+                for block in blocks:
+                    f.write(block)
+            yield from __streamKismet(path, chunkRows)
 
-    return "\n".join(cleanList)
+def __lines(first, blocks):
+    # Split raw blocks into decoded lines, carrying partial lines over to the next block
+    tail = first
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line.rstrip(b"\r").decode(errors="replace")
 
-def __parseAirodump(decoded):
+    for line in tail.split(b"\n"):
+        yield line.rstrip(b"\r").decode(errors="replace")
 
-    bssidData, stationData, _ = decoded.split(b"\r\n\r\n")
+def __iterAirodump(lines, chunkRows):
+    # Airodump writes the AP table first, then the station table, each with its own header
+    section, header, rows = None, None, []
+    for line in lines:
+        if line.startswith("BSSID,") or line.startswith("Station MAC,"):
+            if rows:
+                yield section, __tokenize(header, rows, section == "Station")
+            section, header, rows = "Station" if line.startswith("Station MAC,") else "AP", line, []
+        elif section is not None and line.strip():
+            rows.append(line)
+            if len(rows) >= chunkRows:
+                yield section, __tokenize(header, rows, section == "Station")
+                rows = []
 
-    # Clean up AP table
-    print("Cleaning BSSID data!")
-    bssidData = __cleanup(bssidData.decode())
-    bssidDF = pd.read_csv(io.StringIO(bssidData), header=0)
+    if rows:
+        yield section, __tokenize(header, rows, section == "Station")
 
-    # Clean up client tables
-    print("Cleaning station data!")
-    stationData = __cleanup(stationData.decode(), station=True)
-    stationDF = pd.read_csv(io.StringIO(stationData), quotechar="|", header=0)
+def __toInt(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
 
-    # Change N/A to empty strings. Create dictionaries.
-    bssidDF.fillna("", inplace=True)
-    stationDF.fillna("", inplace=True)
-    bDict = bssidDF.to_dict(orient='records')
-    sDict = stationDF.to_dict(orient='records')
-    return bDict, sDict
+def __tokenize(header, lines, station=False):
+    # Single pass over the raw rows. Airodump quotes ESSIDs containing commas in the AP table,
+    # while the station table ends with a variable-length list of probed ESSIDs.
+    if station:
+        print(f"Parsing {len(lines)} station rows!")
+    else:
+        print(f"Parsing {len(lines)} BSSID rows!")
+
+    headers = list(map(str.strip, header.split(",")))
+    width = len(headers)
+    intCols = [i for i, h in enumerate(headers) if h in INT_COLUMNS]
+    records = []
+
+    if station:
+        fixed = width - 1
+        for line in lines:
+            items = line.split(",", fixed)
+            items += [""] * (width - len(items))
+            fields = [item.strip() for item in items[:fixed]]
+            for i in intCols:
+                fields[i] = __toInt(fields[i])
+            record = dict(zip(headers, fields))
+            record[headers[fixed]] = [essid for essid in map(str.strip, items[fixed].split(",")) if essid]
+            records.append(record)
+    else:
+        essidCol = headers.index("ESSID")
+        for items in csv.reader(lines, skipinitialspace=True):
+            fields = [item.strip() for item in items]
+            if len(fields) > width:
+                # Unquoted commas inside an ESSID
+                extra = len(fields) - width
+                fields[essidCol:essidCol + extra + 1] = [",".join(fields[essidCol:essidCol + extra + 1])]
+            fields += [""] * (width - len(fields))
+            for i in intCols:
+                fields[i] = __toInt(fields[i])
+            records.append(dict(zip(headers, fields)))
+
+    return records
+
+def __streamKismet(path, chunkRows):
+    # Kismet logs keep one row per device with its full state as a JSON blob. Rows are fetched
+    # chunkRows at a time and each blob is only decoded to pull out what airodump would have
+    # written for it, so the nodes come out exactly like an airodump capture's.
+    db = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'devices'").fetchone() is None:
+            print(f"{path} is not a Kismet log!")
+            return
+        print("Kismet received!")
+        # Rows are in first-seen order, where clients often come before their AP. Every AP goes
+        # first so associations and probes never create stubs for APs further down the log.
+        for isAP in (True, False):
+            cursor = db.execute("SELECT devmac, first_time, last_time, strongest_signal, device FROM devices "
+                                "WHERE phyname = 'IEEE802.11' AND (ifnull(type, '') GLOB '*AP*') = ?", (isAP,))
+            for rows in iter(lambda: cursor.fetchmany(chunkRows), []):
+                print(f"Parsing {len(rows)} Kismet {'APs' if isAP else 'clients'}!")
+                bDict, sDict = [], []
+                for mac, first, last, signal, blob in rows:
+                    device = json.loads(blob)
+                    dot11 = device.get('dot11.device') or {}
+                    if isAP:
+                        bDict.append(__kismetAP(mac, device, dot11))
+                    else:
+                        sDict.append(__kismetStation(mac, first, last, signal, device, dot11))
+                yield "Kismet", __makeAirodumpNodes(bDict, sDict)
+    finally:
+        db.close()
+
+def __records(value):
+    # Kismet has written its SSID maps both as lists and as dicts keyed by hash
+    if isinstance(value, dict):
+        return list(value.values())
+    return value or []
+
+def __kismetCrypt(crypt):
+    # Newer Kismet describes encryption as text ("WPA2-PSK"), older versions as a bitset
+    if isinstance(crypt, int):
+        if crypt & (1 << 6):
+            # WPA, CCMP in practice means WPA2
+            priv, cipher = ("WPA2", "CCMP") if crypt & (1 << 9) else ("WPA", "TKIP")
+            return priv, cipher, "MGT" if crypt & (1 << 11) else "PSK" if crypt & (1 << 7) else ""
+        if crypt & (1 << 1):
+            return "WEP", "WEP", ""
+        return ("OPN", "", "") if crypt == 0 else ("", "", "")
+    if crypt is None:
+        return "", "", ""
+
+    crypt = crypt.upper()
+    if crypt in ("", "NONE", "OPEN"):
+        return "OPN", "", ""
+    cipher = "CCMP" if "CCMP" in crypt or "AES" in crypt else "TKIP" if "TKIP" in crypt else "WEP" if "WEP" in crypt else ""
+    auth = "MGT" if "EAP" in crypt or "MGT" in crypt else "SAE" if "SAE" in crypt else "PSK" if "PSK" in crypt else ""
+    return crypt.replace("-", " "), cipher, auth
+
+def __kismetAP(mac, device, dot11):
+    ssids = __records(dot11.get('dot11.device.advertised_ssid_map'))
+    ssid = next((s for s in ssids if s.get('dot11.advertisedssid.beacon')), ssids[0] if ssids else {})
+    crypt = ssid.get('dot11.advertisedssid.crypt_string', ssid.get('dot11.advertisedssid.crypt_set',
+                        device.get('kismet.device.base.crypt')))
+    priv, cipher, auth = __kismetCrypt(crypt)
+    speed = ssid.get('dot11.advertisedssid.maxrate')
+    return {'BSSID': mac, 'ESSID': ssid.get('dot11.advertisedssid.ssid', dot11.get('dot11.device.last_beaconed_ssid', "")),
+            'Speed': int(speed) if speed else "", 'Privacy': priv, 'Cipher': cipher, 'Authentication': auth, 'LAN IP': "",
+            'channel': __toInt(str(ssid.get('dot11.advertisedssid.channel', device.get('kismet.device.base.channel', ""))))}
+
+def __kismetTime(seconds):
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S") if seconds else ""
+
+def __kismetStation(mac, first, last, signal, device, dot11):
+    probed = [p.get('dot11.probedssid.ssid') for p in __records(dot11.get('dot11.device.probed_ssid_map'))]
+    assoc = dot11.get('dot11.device.last_bssid')
+    if assoc in (None, "", mac, "00:00:00:00:00:00", "FF:FF:FF:FF:FF:FF"):
+        assoc = "(not associated)"
+    return {'Station MAC': mac, 'First time seen': __kismetTime(first), 'Last time seen': __kismetTime(last),
+            'Power': signal, '# packets': device.get('kismet.device.base.packets.total', 0), 'BSSID': assoc,
+            'Probed ESSIDs': list(dict.fromkeys(essid for essid in probed if essid))}
 
 def __makeAirodumpNodes(bDict, sDict):
     bssidNodes, stationNodes = [], []
 
     print("Making BSSID nodes!")
-    for entry in bDict:
+    bssidOuis = macLookupMany([entry['BSSID'] for entry in bDict])
+    for entry, oui in zip(bDict, bssidOuis):
         bssid = entry['BSSID']
         essid = entry['ESSID']
         speed = entry['Speed']
@@ -91,8 +297,6 @@ def __makeAirodumpNodes(bDict, sDict):
         if  len(essid) == 0:
             essid = bssid
         
-        oui = macLookup(bssid)
-        
         if "WPA2" in priv:
             bNode = {'type': "WPA2", 'name': essid, 'bssid':bssid, 'oui':oui, 'encryption':"WPA2", 'speed':speed, 'channel':channel, 'auth':auth, 'cipher':cipher, 'lan':lan}
         elif "WPA" in priv:
@@ -108,8 +312,9 @@ def __makeAirodumpNodes(bDict, sDict):
 
     #Parse list of clients and add probe relations
     print("Making station nodes!")
-    for entry in sDict:
-        essids = entry['Probed ESSIDs'].split(",")
+    stationOuis = macLookupMany([entry['Station MAC'] for entry in sDict])
+    for entry, oui in zip(sDict, stationOuis):
+        essids = entry['Probed ESSIDs']
         station = entry['Station MAC']
         fts = entry['First time seen']
         lts = entry['Last time seen']
@@ -120,7 +325,6 @@ def __makeAirodumpNodes(bDict, sDict):
         else:
             bssid = None
 
-        oui = macLookup(station)
         sNode = {'type': "Client", 'name': station, 'bssid': station, 'fts': fts, 'lts': lts, 'pwr': pwr, 'pkts': pkts, 'assoc': bssid, 'oui': oui}
         
         stationNodes.append([essids, sNode])
@@ -0,0 +1,84 @@
+import threading
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+class PoolTimeout(Exception):
+    pass
+
+class SessionPool:
+    # Bounds how many callbacks talk to the database at once. py2neo keeps its own bolt connection
+    # pool behind the Graph, this hands out slots in front of it so a burst of callbacks queues
+    # here (where the wait is measured) instead of opening connections past MaxConnections.
+    def __init__(self, graph, size, timeout, keepAlive=0):
+        self.graph = graph
+        self.size = size
+        self.timeout = timeout
+        self.keepAlive = keepAlive
+        self.acquired = 0
+        self.timeouts = 0
+        self.inUse = 0
+        self.peak = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.waits = {}
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__lock = threading.Lock()
+        self.__lastUsed = perf_counter()
+
+        if keepAlive > 0:
+            pinger = threading.Thread(target=self.__keepAlive, name="pool-keepalive")
+            pinger.daemon = True
+            pinger.start()
+
+    @contextmanager
+    def session(self, name="query"):
+        # with pool.session("searchNodes") as graph: ... runs with one of the pool slots held
+        start = perf_counter()
+        ok = self.__slots.acquire(timeout=self.timeout)
+        waited = perf_counter() - start
+        with self.__lock:
+            if not ok:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+                self.inUse += 1
+                self.peak = max(self.peak, self.inUse)
+                self.waitTotal += waited
+                self.waitMax = max(self.waitMax, waited)
+                w = self.waits.setdefault(name, [0, 0.0])
+                w[0] += 1
+                w[1] += waited
+        if not ok:
+            raise PoolTimeout(f"{name}: all {self.size} database sessions still busy after {self.timeout}s")
+
+        try:
+            yield self.graph
+        finally:
+            with self.__lock:
+                self.inUse -= 1
+                self.__lastUsed = perf_counter()
+            self.__slots.release()
+
+    def __keepAlive(self):
+        # Idle bolt connections get dropped by firewalls and NAT, a trivial query keeps one warm
+        while True:
+            sleep(self.keepAlive)
+            if perf_counter() - self.__lastUsed < self.keepAlive:
+                continue
+            try:
+                with self.session("keepalive") as graph:
+                    graph.run("RETURN 1").evaluate()
+            except Exception as e:
+                print(f"Keep-alive failed: {e}")
+
+    def stats(self):
+        with self.__lock:
+            return {'size': self.size, 'inUse': self.inUse, 'peak': self.peak, 'acquired': self.acquired,
+                    'timeouts': self.timeouts, 'waitAvg': self.waitTotal / self.acquired if self.acquired else 0.0,
+                    'waitMax': self.waitMax,
+                    'waitByQuery': {name: total / calls for name, (calls, total) in self.waits.items()}}
+
+    def summary(self):
+        s = self.stats()
+        return (f"{s['inUse']}/{s['size']} in use (peak {s['peak']}), wait avg {s['waitAvg'] * 1000:.1f} ms, "
+                f"max {s['waitMax'] * 1000:.1f} ms, {s['timeouts']} timeouts")
@@ -1,12 +1,19 @@
-NAMES_QUERY = '''MATCH (n) WHERE EXISTS(n.name) RETURN DISTINCT n.name AS name ORDER BY name'''
-BSSID_QUERY = '''MATCH (n) WHERE EXISTS(n.bssid) RETURN DISTINCT n.bssid AS bssid ORDER BY bssid'''
-OUI_QUERY = '''MATCH (n) WHERE EXISTS(n.oui) RETURN DISTINCT n.oui AS oui ORDER BY oui'''
-TYPE_QUERY = '''MATCH (n) WITH DISTINCT labels(n) AS types UNWIND types AS type RETURN DISTINCT type ORDER BY type'''
-AUTH_QUERY = '''MATCH (n) WHERE EXISTS(n.auth) RETURN DISTINCT n.auth AS auth ORDER BY auth'''
-CIPHER_QUERY = '''MATCH (n) WHERE EXISTS(n.cipher) RETURN DISTINCT n.cipher AS cipher ORDER BY cipher'''
-CHANNEL_QUERY = '''MATCH (n) WHERE EXISTS(n.channel) RETURN DISTINCT n.channel AS channel ORDER BY channel'''
-SPEED_QUERY = '''MATCH (n) WHERE EXISTS(n.speed) RETURN DISTINCT n.speed AS speed ORDER BY speed'''
-LANIP_QUERY = '''MATCH (n) WHERE EXISTS(n.lan) RETURN DISTINCT n.lan AS lan ORDER BY lan'''
+CATALOG_FIELDS = ['name', 'bssid', 'oui', 'auth', 'cipher', 'channel', 'speed', 'lan']
+# Every filter dropdown's distinct values and their node counts in one scan
+CATALOG_QUERY = ("MATCH (n:Device) UNWIND [" + ", ".join(f"['{f}', n.{f}]" for f in CATALOG_FIELDS) +
+                "] + [l IN labels(n) | ['type', l]] AS pair WITH pair WHERE pair[1] IS NOT NULL " +
+                "RETURN pair[0] AS prop, pair[1] AS value, count(*) AS cnt")
+STATS_LABELS = ['Client', 'AP', 'WPA2', 'WPA', 'WEP', 'Open']
+STATS_RELATIONS = {'Probes': 'Probes', 'Assoc': 'AssociatedTo'}
+
+def __statsQuery():
+    # Every branch counts a single label or relationship type, which Neo4j answers from its count
+    # store. Branches without grouping keys always return a row, even for a count of 0.
+    parts = [f"MATCH (n:{label}) RETURN '{label}' AS name, count(n) AS cnt" for label in STATS_LABELS]
+    parts += [f"MATCH ()-[r:{rel}]->() RETURN '{name}' AS name, count(r) AS cnt" for name, rel in STATS_RELATIONS.items()]
+    return "\nUNION ALL\n".join(parts)
+
+STATS_QUERY = __statsQuery()
 DELETEDB_QUERY = '''MATCH (n) DETACH DELETE n'''
 
 CONSTRAINT_QUERIES=[
@@ -18,10 +25,57 @@ CONSTRAINT_QUERIES=[
         '''CREATE CONSTRAINT ON (n:AP) ASSERT n.name IS UNIQUE''',
         '''CREATE CONSTRAINT ON (n:Device) ASSERT n.bssid IS UNIQUE'''
         ]
+
+# Searchable Device properties. bssid is already backed by its uniqueness constraint.
+INDEXED_PROPS = ['name', 'oui', 'auth', 'cipher', 'channel', 'speed', 'lan']
+INDEX_QUERIES = [f"CREATE INDEX ON :Device({prop})" for prop in INDEXED_PROPS]
+INDEX_STATUS_QUERY = '''CALL db.indexes()'''
+
+AP_LABELS = ["WPA2", "WPA", "WEP", "Open", "AP"]
+
+def mergeBssidNodes(label):
+    # Existing devices are left untouched, same as a failed CREATE on the bssid constraint, except
+    # for the nameless AP stubs an association creates before the AP's own row is seen: those are
+    # upgraded to the real AP. Probe-only APs share the AP.name constraint, so skip rows whose name
+    # is already taken.
+    apGuard = "OPTIONAL MATCH (m:AP {name: row.name}) WITH row WHERE m IS NULL" if label == "AP" else ""
+    props = ("n.name = row.name, n.oui = row.oui, n.encryption = row.encryption, n.speed = row.speed, "
+                "n.channel = row.channel, n.auth = row.auth, n.cipher = row.cipher, n.lan = row.lan")
+    return (f'''UNWIND $rows AS row
+            {apGuard}
+            MERGE (n:Device {{bssid: row.bssid}})
+            ON CREATE SET n:{label}, {props}
+            WITH n, row
+            FOREACH (stub IN CASE WHEN n:AP AND n.name IS NULL THEN [1] ELSE [] END |
+                REMOVE n:AP SET n:{label}, {props})''')
+
+MERGE_STATIONS = '''UNWIND $rows AS row
+            MERGE (n:Device {bssid: row.bssid})
+            ON CREATE SET n:Client, n.name = row.name, n.oui = row.oui
+            SET n.FirstTimeSeen = row.fts, n.LastTimeSeen = row.lts, n.Power = row.pwr,
+                n.NumPackets = row.pkts, n.Association = row.assoc'''
+
+MERGE_PROBED_APS = '''UNWIND $rows AS name
+            OPTIONAL MATCH (e:Device {name: name})
+            WITH name, e WHERE e IS NULL
+            MERGE (p:AP {name: name})
+            ON CREATE SET p:Device'''
+
+MERGE_PROBES = '''UNWIND $rows AS row
+            MATCH (s:Device {bssid: row.station})
+            MATCH (e:Device {name: row.essid})
+            WITH s, row, collect(e)[0] AS e
+            MERGE (s)-[:Probes]->(e)'''
+
+MERGE_ASSOCIATIONS = '''UNWIND $rows AS row
+            MATCH (s:Device {bssid: row.station})
+            MERGE (a:Device {bssid: row.assoc})
+            ON CREATE SET a:AP
+            MERGE (s)-[:AssociatedTo]->(a)'''
 ALL = (r'''MATCH (a)-[r]->(b)
         WITH
         {
-            id: toString(id(a)) + toString(id(b)),
+            id: toString(id(a)) + '-' + type(r) + '-' + toString(id(b)),
             source: id(a),
             target: id(b),
             name: type(r)
@@ -51,13 +105,13 @@ ALL = (r'''MATCH (a)-[r]->(b)
             lan: b.lan
         }
         AS aps
-        RETURN {nodes: collect(distinct clients) + collect(distinct aps), edges: collect(distinct edges)}
+        RETURN clients AS a, aps AS b, edges AS edge
         ''')
 
 INITIAL = (r'''MATCH p=(a)-[r]->(b)
             WITH
             {
-                id: toString(id(a)) + toString(id(b)),
+                id: toString(id(a)) + '-' + type(r) + '-' + toString(id(b)),
                 source: id(a),
                 target: id(b),
                 name: type(r)
@@ -87,19 +141,33 @@ INITIAL = (r'''MATCH p=(a)-[r]->(b)
                 lan: b.lan
             }
             AS aps
-            RETURN {nodes: collect(distinct clients) + collect(distinct aps), edges: collect(distinct edges)} LIMIT 100
+            RETURN clients AS a, aps AS b, edges AS edge LIMIT 100
             ''')
 
-def searchRelations(value, prop):
-    return (f'''MATCH (a)-[r]->(b) WHERE a.{prop} IN {value} OR b.{prop} IN {value}
-            WITH
-            {{
-                id: toString(id(a)) + toString(id(b)),
-                source: id(a),
-                target: id(b),
-                name: type(r)
-            }}
-            AS edges,
+# Property and label names cannot be Cypher parameters, so they are checked against these lists
+# and only the searched values travel as $values. Each search shape keeps one stable query text
+# and hits the server's plan cache.
+SEARCH_PROPS = CATALOG_FIELDS
+SEARCH_LABELS = AP_LABELS + ["Client", "Device"]
+
+def checkProp(prop):
+    if prop not in SEARCH_PROPS:
+        raise ValueError(f"Unknown search property: {prop}")
+    return prop
+
+def checkLabel(label):
+    if label not in SEARCH_LABELS:
+        raise ValueError(f"Unknown search label: {label}")
+    return label
+
+def __searchQuery(match):
+    # Anchor on the matching nodes first, then expand to their relationships. Matching nodes
+    # without any relationship come back as a row with only b set.
+    return (f'''{match}
+            OPTIONAL MATCH (m)-[r]-()
+            WITH r, CASE WHEN r IS NULL THEN null ELSE startNode(r) END AS a, coalesce(endNode(r), m) AS b
+            RETURN
+            CASE WHEN r IS NULL THEN null ELSE
             {{
                 id: id(a),
                 name: a.name,
@@ -109,8 +177,8 @@ def searchRelations(value, prop):
                 fts: a.fts,
                 lts: a.lts,
                 pwr: toString(a.pwr)
-            }}
-            AS clients,
+            }} END
+            AS a,
             {{
                 id: id(b),
                 name: b.name,
@@ -123,80 +191,25 @@ def searchRelations(value, prop):
                 cipher: b.cipher,
                 lan: b.lan
             }}
-            AS aps
-            RETURN {{nodes: collect(distinct clients) + collect(distinct aps), edges: collect(distinct edges)}}
-            ''')
-
-def searchNoRelations(value, prop):
-    return (f'''MATCH (b) WHERE b.{prop} IN {value} AND NOT (b)--()
-            WITH
-            {{
-                id: id(b),
-                name: b.name,
-                type: labels(b),
-                oui: b.OUI,
-                bssid: b.bssid,
-                channel: toString(b.channel),
-                speed: toString(b.speed),
-                auth: b.auth,
-                cipher: b.cipher,
-                lan: b.lan
-            }}
-            AS aps
-            RETURN {{nodes: collect(distinct aps) }}''')
-
-def searchLabelRelations(value):
-    return (f'''MATCH (a)-[r]->(b:{value})
-            WITH
+            AS b,
+            CASE WHEN r IS NULL THEN null ELSE
             {{
-                id: toString(id(a)) + toString(id(b)),
+                id: toString(id(a)) + '-' + type(r) + '-' + toString(id(b)),
                 source: id(a),
                 target: id(b),
                 name: type(r)
-            }}
-            AS edges,
-            {{
-                id: id(a),
-                name: a.name,
-                type: labels(a),
-                bssid: a.bssid,
-                oui: a.oui,
-                fts: a.fts,
-                lts: a.lts,
-                pwr: toString(a.pwr)
-            }}
-            AS clients,
-            {{
-                id: id(b),
-                name: b.name,
-                type: labels(b),
-                oui: b.oui,
-                bssid: b.bssid,
-                channel: toString(b.channel),
-                speed: toString(b.speed),
-                auth: b.auth,
-                cipher: b.cipher,
-                lan: b.lan
-            }}
-            AS aps
-            RETURN {{nodes: collect(distinct clients) + collect(distinct aps), edges: collect(distinct edges)}}
+            }} END
+            AS edge
             ''')
 
-def searchLabelNoRelations(value):
-    return (f'''MATCH (b:{value}) WHERE NOT (b)--()
-            WITH
-            {{
-                id: id(b),
-                name: b.name,
-                type: labels(b),
-                oui: b.OUI,
-                bssid: b.bssid,
-                channel: toString(b.channel),
-                speed: toString(b.speed),
-                auth: b.auth,
-                cipher: b.cipher,
-                lan: b.lan
-            }}
-            AS aps
-            RETURN {{nodes: collect(distinct aps) }}''')
+def searchNodes(prop):
+    prop = checkProp(prop)
+    return __searchQuery(f"MATCH (m:Device) WHERE m.{prop} IN $values")
+
+def searchLabel(label):
+    label = checkLabel(label)
+    return __searchQuery(f"MATCH (m:{label})")
 
+def searchIds():
+    # Members of a collapsed cluster, by node id
+    return __searchQuery("MATCH (m:Device) WHERE id(m) IN $ids")
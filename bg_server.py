@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Headless BeaconGraph for a shared team server, no Qt login dialog or browser window.
+#   python bg_server.py                          gunicorn with the [server] settings
+#   gunicorn -w 4 --threads 8 bg_server:server   or any other WSGI server
+# Credentials come from BEACONGRAPH_URI / BEACONGRAPH_USER / BEACONGRAPH_PASSWORD, falling back
+# to the [neo4j] section of settings.cfg.
+import os
+import sys
+import configparser
+
+config = configparser.ConfigParser()
+config.read('settings.cfg')
+VERSION_FILE = ".bg-version"
+
+def credentials():
+    return (os.environ.get('BEACONGRAPH_URI', config['neo4j']['Uri']),
+            os.environ.get('BEACONGRAPH_USER', config['neo4j']['User']),
+            os.environ.get('BEACONGRAPH_PASSWORD', config['neo4j']['Password']))
+
+def createServer():
+    # Called once per worker process, each one gets its own neoHandler and connection pool
+    from neoHandler import neoHandler, config as handlerConfig
+    from BeaconGraph import BeaconGraph
+
+    if not handlerConfig.get('server', 'VersionFile', fallback=''):
+        # Workers only see each other's writes through a shared version file
+        handlerConfig.read_dict({'server': {'VersionFile': VERSION_FILE}})
+
+    uri, user, passwd = credentials()
+    neo = neoHandler(uri, user, passwd)
+    print(f"Worker {os.getpid()} connected to {neo.uri} as {user}")
+    return BeaconGraph(neo).app.server
+
+def run():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("The headless server needs gunicorn: pip3 install gunicorn")
+
+    class BeaconGraphServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{config.get('server', 'Host', fallback='0.0.0.0')}:{config.getint('server', 'Port', fallback=9001)}")
+            workers = config.getint('server', 'Workers', fallback=4)
+            if config.get('storage', 'Backend', fallback='neo4j') == "embedded" and workers > 1:
+                # Every worker would hold its own copy of the graph
+                print("The embedded backend lives in one process, running a single worker")
+                workers = 1
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', config.getint('server', 'Threads', fallback=8))
+            self.cfg.set('worker_class', 'gthread')
+            # Uploads parse and insert in the background, but large ones still take a while to post
+            self.cfg.set('timeout', config.getint('server', 'Timeout', fallback=300))
+
+        def load(self):
+            # Not preloaded, this runs in every worker after the fork
+            return createServer()
+
+    BeaconGraphServer().run()
+
+if __name__ == '__main__':
+    run()
+elif __name__ != '__mp_main__':
+    # gunicorn bg_server:server imports this module in each worker. Upload parser processes
+    # import it as __mp_main__ and must not start a server of their own.
+    server = createServer()
@@ -0,0 +1,206 @@
+import bg_metrics
+import bg_presets
+from bg_pool import SessionPool
+
+class GraphStore:
+    # What neoHandler needs from a storage backend. Reads return rows shaped like the Cypher
+    # presets, {a: node map or None, b: node map, edge: edge map or None}, so dataToJSON, the
+    # caches and the clustering sit on top of any backend unchanged. Writes take the batched
+    # rows of insertAiroData and return (nodes created, relationships created).
+    uri = None
+
+    def mergeBssidNodes(self, label, rows):
+        raise NotImplementedError
+
+    def mergeStations(self, rows):
+        raise NotImplementedError
+
+    def mergeProbedAPs(self, names):
+        raise NotImplementedError
+
+    def mergeProbes(self, rows):
+        raise NotImplementedError
+
+    def mergeAssociations(self, rows):
+        raise NotImplementedError
+
+    def flush(self):
+        # Called after an ingest or deleteDB finished writing
+        pass
+
+    def catalog(self):
+        # (prop, value, count) for every distinct value of CATALOG_FIELDS and every label as 'type'
+        raise NotImplementedError
+
+    def stats(self):
+        # (name, count) for STATS_LABELS and STATS_RELATIONS
+        raise NotImplementedError
+
+    def initial(self):
+        raise NotImplementedError
+
+    def searchNodes(self, prop, values):
+        raise NotImplementedError
+
+    def searchLabel(self, label):
+        raise NotImplementedError
+
+    def searchIds(self, ids):
+        raise NotImplementedError
+
+    def deleteAll(self):
+        raise NotImplementedError
+
+    def indexStatus(self):
+        # [(description, state, progress %)]
+        return []
+
+    def profilePresets(self, catalog):
+        return ""
+
+    def summary(self):
+        return "-"
+
+def openStore(backend, uri, user, passwd, config):
+    if backend == "embedded":
+        from bg_embedded import EmbeddedStore
+        return EmbeddedStore(config.get('storage', 'Path', fallback='beacongraph.bgdb'))
+    if backend != "neo4j":
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return Neo4jStore(uri, user, passwd, config.getint('neo4j', 'MaxConnections', fallback=16),
+                        config.getfloat('neo4j', 'AcquireTimeout', fallback=30.0),
+                        config.getfloat('neo4j', 'KeepAlive', fallback=60.0))
+
+class Neo4jStore(GraphStore):
+    def __init__(self, uri, user, passwd, poolSize=16, timeout=30.0, keepAlive=60.0):
+        # Imported here so the embedded backend runs without the Neo4j driver installed
+        from py2neo import Graph
+        self.graph = Graph(uri, auth=(user, passwd), max_connections=poolSize)
+        self.pool = SessionPool(self.graph, poolSize, timeout, keepAlive)
+        self.uri = self.graph.database.uri
+
+        with self.pool.session("constraints") as graph:
+            for con in bg_presets.CONSTRAINT_QUERIES:
+                graph.run(con)
+        # CREATE INDEX is a no-op for existing indexes, population happens in the background
+        with self.pool.session("indexes") as graph:
+            for query in bg_presets.INDEX_QUERIES:
+                graph.run(query)
+
+    def rows(self, name, query, params=None):
+        # The session is held until the last record is consumed. The server's own timings from the
+        # result summary split planning from streaming without the network in between.
+        with self.pool.session(name) as graph:
+            cursor = graph.run(query, params or {})
+            for record in cursor:
+                yield record.data()
+            summary = cursor.summary()
+        bg_metrics.observeServerTimes(name, self.__summaryField(summary, 'result_available_after'),
+                                        self.__summaryField(summary, 'result_consumed_after'))
+
+    @staticmethod
+    def __summaryField(summary, name):
+        # py2neo hands back the driver's summary object, or a plain dict in some versions
+        if isinstance(summary, dict):
+            return summary.get(name)
+        return getattr(summary, name, None)
+
+    def write(self, query, rows):
+        with self.pool.session("ingest") as graph:
+            tx = graph.begin()
+            stats = tx.run(query, rows=rows).stats()
+            tx.commit()
+        return stats.get('nodes_created', 0), stats.get('relationships_created', 0)
+
+    def mergeBssidNodes(self, label, rows):
+        return self.write(bg_presets.mergeBssidNodes(label), rows)
+
+    def mergeStations(self, rows):
+        return self.write(bg_presets.MERGE_STATIONS, rows)
+
+    def mergeProbedAPs(self, names):
+        return self.write(bg_presets.MERGE_PROBED_APS, names)
+
+    def mergeProbes(self, rows):
+        return self.write(bg_presets.MERGE_PROBES, rows)
+
+    def mergeAssociations(self, rows):
+        return self.write(bg_presets.MERGE_ASSOCIATIONS, rows)
+
+    def catalog(self):
+        for row in self.rows("catalog", bg_presets.CATALOG_QUERY):
+            yield row['prop'], row['value'], row['cnt']
+
+    def stats(self):
+        with self.pool.session("stats") as graph:
+            rows = graph.run(bg_presets.STATS_QUERY).data()
+        return [(row['name'], row['cnt']) for row in rows]
+
+    def initial(self):
+        return self.rows("initial", bg_presets.INITIAL)
+
+    def searchNodes(self, prop, values):
+        return self.rows(f"searchNodes({prop})", bg_presets.searchNodes(prop), {'values': values})
+
+    def searchLabel(self, label):
+        return self.rows(f"searchLabel({label})", bg_presets.searchLabel(label))
+
+    def searchIds(self, ids):
+        return self.rows("searchIds", bg_presets.searchIds(), {'ids': ids})
+
+    def deleteAll(self):
+        with self.pool.session("deleteDB") as graph:
+            graph.run(bg_presets.DELETEDB_QUERY)
+
+    def indexStatus(self):
+        status = []
+        with self.pool.session("indexStatus") as graph:
+            rows = graph.run(bg_presets.INDEX_STATUS_QUERY).data()
+        for row in rows:
+            progress = row.get('progress')
+            status.append((row.get('description'), row.get('state'), 100.0 if progress is None else progress))
+        return status
+
+    def profilePresets(self, catalog):
+        # PROFILE every search preset against real values from the catalog and report whether
+        # the planner anchors on an index
+        presets = [("CATALOG_QUERY", bg_presets.CATALOG_QUERY, {})]
+        for prop in bg_presets.SEARCH_PROPS:
+            values = [v for v, _ in catalog[prop][:1]] or [""]
+            presets.append((f"searchNodes({prop})", bg_presets.searchNodes(prop), {'values': values}))
+        for label in bg_presets.SEARCH_LABELS:
+            presets.append((f"searchLabel({label})", bg_presets.searchLabel(label), {}))
+
+        report = []
+        for name, query, params in presets:
+            with self.pool.session("profile") as graph:
+                cursor = graph.run("PROFILE " + query, params)
+                cursor.data()
+                lines = self.__planLines(cursor.plan())
+            usesIndex = any("Index" in line for line in lines)
+            report.append(f"== {name} ({'index' if usesIndex else 'NO INDEX'})")
+            report.extend(lines)
+        return "\n".join(report)
+
+    @staticmethod
+    def __planLines(plan, depth=0):
+        if plan is None:
+            return []
+        def field(*names):
+            for n in names:
+                value = getattr(plan, n, None)
+                if value is None and isinstance(plan, dict):
+                    value = plan.get(n)
+                if value is not None:
+                    return value
+        args = field('arguments', 'args') or {}
+        line = f"{'  ' * depth}{field('operator_type', 'operatorType')} {', '.join(field('identifiers') or [])}"
+        if 'DbHits' in args or 'Rows' in args:
+            line += f" (rows {args.get('Rows')}, db hits {args.get('DbHits')})"
+        lines = [line]
+        for child in field('children') or []:
+            lines.extend(Neo4jStore.__planLines(child, depth + 1))
+        return lines
+
+    def summary(self):
+        return self.pool.summary()
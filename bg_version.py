@@ -0,0 +1,68 @@
+import contextlib
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# data is bumped by every write to the graph and cached reads compare against it. settled is
+# the data version at the end of the last ingest, the UI refreshes when that moves. deletes
+# counts deleteDB calls, the capture watcher starts over when it moves. cancels counts Cancel
+# Upload clicks, uploads submitted before one stop.
+SLOTS = ['data', 'settled', 'deletes', 'cancels']
+SIZE = 8 * len(SLOTS)
+
+class DataVersion:
+    # Without a path the counters live in this process. With one, worker processes of a headless
+    # server share them through a small memory mapped file: reads are a memory access, writes
+    # happen under an exclusive lock on the file.
+    def __init__(self, path=""):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__local = dict.fromkeys(SLOTS, 0)
+        self.__fd = None
+        self.__map = None
+        if path:
+            self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            with self.__locked():
+                if os.fstat(self.__fd).st_size != SIZE:
+                    # New file, or one left behind by an older version
+                    os.ftruncate(self.__fd, 0)
+                    os.ftruncate(self.__fd, SIZE)
+            self.__map = mmap.mmap(self.__fd, SIZE)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        with self.__lock:
+            if self.__fd is not None and fcntl is not None:
+                fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self.__fd is not None and fcntl is not None:
+                    fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+    def get(self, slot='data'):
+        if self.__map is None:
+            return self.__local[slot]
+        return struct.unpack_from('<Q', self.__map, 8 * SLOTS.index(slot))[0]
+
+    def __write(self, slot, value):
+        if self.__map is None:
+            self.__local[slot] = value
+        else:
+            struct.pack_into('<Q', self.__map, 8 * SLOTS.index(slot), value)
+
+    def set(self, slot, value):
+        with self.__locked():
+            self.__write(slot, value)
+
+    def bump(self, slot='data'):
+        with self.__locked():
+            value = self.get(slot) + 1
+            self.__write(slot, value)
+            return value
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Live capture mode: follow the CSVs airodump-ng rewrites every few seconds and only write what
+# changed since the last pass. Runs inside the app when [watch] Paths is set, or on its own:
+#   python bg_watch.py 'captures/*.csv' [...]
+import glob
+import itertools
+import os
+import sys
+import threading
+import traceback
+from time import perf_counter
+import bg_parsers
+from bg_jobs import IngestJob
+
+# Station columns that change while a capture is running
+STATION_FIELDS = ('fts', 'lts', 'pwr', 'pkts', 'assoc')
+
+class CaptureSnapshot:
+    # What has been written for one capture file so far
+    def __init__(self):
+        self.stamp = None
+        self.aps = set()
+        self.stations = {}
+        self.probes = set()
+
+class CaptureWatcher:
+    def __init__(self, neo, patterns, interval=3.0, flushInterval=60.0, lockPath=".bg-watch.lock"):
+        self.neo = neo
+        self.patterns = patterns
+        self.interval = interval
+        self.flushInterval = flushInterval
+        self.lockPath = lockPath
+        self.snapshots = {}
+        self.probedNames = set()
+        self.generation = neo.deleteGeneration
+        self.passes = 0
+        self.last = None
+        self.__ids = itertools.count(1)
+        self.__stop = threading.Event()
+        self.__lockFile = None
+        self.__unflushed = False
+        self.__flushed = perf_counter()
+
+    def start(self):
+        # Only one process may write a capture, other server workers leave it to the first
+        if not self.claim():
+            print(f"Another process is already watching {', '.join(self.patterns)}")
+            return False
+        thread = threading.Thread(target=self.run, name="capture-watcher")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def stop(self):
+        self.__stop.set()
+
+    def claim(self):
+        if not self.lockPath:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        self.__lockFile = open(self.lockPath, "w")
+        try:
+            fcntl.flock(self.__lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.__lockFile.close()
+            self.__lockFile = None
+            return False
+        return True
+
+    def run(self):
+        print(f"Watching {', '.join(self.patterns)} every {self.interval:.0f}s")
+        while True:
+            wrote = False
+            for path in self.paths():
+                try:
+                    wrote = self.poll(path) is not None or wrote
+                except Exception:
+                    traceback.print_exc()
+            self.passes += 1
+            self.flush(force=not wrote)
+            if self.__stop.wait(self.interval):
+                self.flush(force=True)
+                return
+
+    def flush(self, force=False):
+        # While the captures keep changing only every flushInterval seconds, and on the first quiet pass
+        if self.__unflushed and (force or perf_counter() - self.__flushed >= self.flushInterval):
+            self.neo.store.flush()
+            self.__unflushed, self.__flushed = False, perf_counter()
+
+    def paths(self):
+        # Patterns are re-expanded every pass, airodump starts a new -NN.csv when it restarts
+        return sorted({path for pattern in self.patterns for path in glob.glob(pattern)})
+
+    @staticmethod
+    def __stamp(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self, path):
+        generation = self.neo.deleteGeneration
+        if generation != self.generation:
+            # The graph was deleted, everything in the captures has to be written again
+            print("Database deleted, re-reading all captures")
+            self.snapshots, self.probedNames, self.generation = {}, set(), generation
+        snapshot = self.snapshots.setdefault(path, CaptureSnapshot())
+        stamp = self.__stamp(path)
+        if stamp is None or stamp == snapshot.stamp:
+            return None
+
+        start = perf_counter()
+        bssidNodes, stationNodes = [], []
+        for dType, (bNodes, sNodes) in bg_parsers.streamFile(path):
+            bssidNodes.extend(bNodes)
+            stationNodes.extend(sNodes)
+        if self.__stamp(path) != stamp:
+            # airodump was rewriting the file while we read it, take it on the next pass
+            return None
+
+        aps, stations, probedNames, probes, assocs = self.diff(snapshot, bssidNodes, stationNodes)
+        job = None
+        if aps or stations or probes or assocs:
+            job = IngestJob(next(self.__ids), [], [os.path.basename(path)])
+            job.state, job.started, job.rowsParsed = "running", start, len(bssidNodes) + len(stationNodes)
+            self.neo.writeAiroData(aps, stations, probedNames, probes, assocs, job)
+            self.neo.dataSettled()
+            job.state, job.finished = "done", perf_counter()
+            self.__unflushed = True
+            self.last = job
+            print(f"{path}: +{len(aps)} APs, {len(stations)} new or changed stations, +{len(probes)} probes, "
+                    f"+{len(assocs)} associations in {job.elapsed():.2f}s")
+
+        if self.neo.deleteGeneration != generation:
+            # Deleted while writing, the next pass starts over
+            return job
+
+        # Only remembered once written, a failed write is retried on the next pass
+        snapshot.stamp = stamp
+        snapshot.aps.update(b['bssid'] for b in aps)
+        for s in stations:
+            snapshot.stations[s['bssid']] = tuple(s.get(f) for f in STATION_FIELDS)
+        snapshot.probes.update((p['station'], p['essid']) for p in probes)
+        self.probedNames |= probedNames
+        return job
+
+    def diff(self, snapshot, bssidNodes, stationNodes):
+        # New APs, new stations or ones whose times/power/packets/association moved, and
+        # probes and associations not written before
+        aps = list({b['bssid']: b for b in bssidNodes if b['bssid'] not in snapshot.aps}.values())
+        stations, probedNames, probes, assocs = [], set(), [], []
+        for essids, s in stationNodes:
+            old = snapshot.stations.get(s['bssid'])
+            if old != tuple(s.get(f) for f in STATION_FIELDS):
+                stations.append(s)
+                if s['assoc'] is not None and (old is None or old[-1] != s['assoc']):
+                    assocs.append({'station': s['bssid'], 'assoc': s['assoc']})
+            for essid in essids:
+                if essid and (s['bssid'], essid) not in snapshot.probes:
+                    probes.append({'station': s['bssid'], 'essid': essid})
+                    if essid not in self.probedNames:
+                        probedNames.add(essid)
+        return aps, stations, probedNames, probes, assocs
+
+    def status(self):
+        line = f"Watching {len(self.snapshots)} captures every {self.interval:.0f}s, {self.passes} passes"
+        if self.last is not None:
+            line += f"\n{self.last.status()}"
+        return line
+
+if __name__ == '__main__':
+    # Ingest only, no UI, with the credentials and backend from settings.cfg
+    from neoHandler import neoHandler, config
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python bg_watch.py 'captures/*.csv' [...]")
+    neo = neoHandler(config['neo4j']['Uri'], config['neo4j']['User'], config['neo4j']['Password'])
+    watcher = CaptureWatcher(neo, sys.argv[1:], config.getfloat('watch', 'Interval', fallback=3.0),
+                            config.getfloat('watch', 'FlushInterval', fallback=60.0))
+    if not watcher.claim():
+        sys.exit("Another BeaconGraph process is already watching captures")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.flush(force=True)
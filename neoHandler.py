@@ -1,15 +1,22 @@
 from time import sleep
-from py2neo import Graph, Node, Relationship
-from py2neo.database import ClientError
 from collections import Counter
 import json
 import base64
 import pandas
 import bg_presets
+from bg_cache import ResultCache
+from bg_store import openStore
+from bg_metrics import InstrumentedStore
+from bg_version import DataVersion
 import configparser
+import threading
+import bisect
+import heapq
 
 config = configparser.ConfigParser()
 config.read('settings.cfg')
+# Cluster groupings, coarsest first
+CLUSTER_PROPS = ['type', 'channel', 'oui', 'name']
 
 class neoHandler:
     def __init__(self,uri,user, passwd):
@@ -24,14 +31,31 @@ class neoHandler:
         self.CLIENT_COLOR = config['legend']['Client']
         self.PROBE_COLOR = config['legend']['Probes']
         self.ASSOC_COLOR = config['legend']['AssociatedTo']
+        self.BATCH_SIZE = config.getint('ingest', 'BatchSize', fallback=5000)
+        self.PARSE_WORKERS = config.getint('ingest', 'ParseWorkers', fallback=0)
+        self.TYPEAHEAD_LIMIT = config.getint('search', 'TypeaheadLimit', fallback=50)
+        self.ELEMENT_BUDGET = config.getint('search', 'ElementBudget', fallback=1500)
+        self.CLUSTER_BY = config.get('search', 'ClusterBy', fallback='type')
+        self.LAYOUT_ENGINE = config.get('layout', 'Engine', fallback='client')
+        self.VERSION_FILE = config.get('server', 'VersionFile', fallback='')
+        self.BACKEND = config.get('storage', 'Backend', fallback='neo4j')
+        self.WATCH_PATHS = [p.strip() for p in config.get('watch', 'Paths', fallback='').split(',') if p.strip()]
+        self.WATCH_INTERVAL = config.getfloat('watch', 'Interval', fallback=3.0)
+        self.WATCH_FLUSH_INTERVAL = config.getfloat('watch', 'FlushInterval', fallback=60.0)
         
-        self.graph = Graph(uri, auth=(user, passwd))
+        # neo4j talks Bolt to a server, embedded keeps the graph in this process (bg_embedded.py).
+        # Every call into it is timed for /metrics.
+        self.store = InstrumentedStore(openStore(self.BACKEND, uri, user, passwd, config))
         self.user = user
-        self.uri = self.graph.database.uri
+        self.uri = self.store.uri
         self.INITIAL = True
-        
-        for con in bg_presets.CONSTRAINT_QUERIES:
-            self.graph.run(con)
+        self.ensureIndexes()
+
+        self.versions = DataVersion(self.VERSION_FILE)
+        self.__catalog, self.__catalogIndex, self.__catalogVersion = None, None, -1
+        self.__catalogLock = threading.Lock()
+        self.__stats, self.__statsVersion = None, -1
+        self.resultCache = ResultCache(config.getint('search', 'ResultCacheMB', fallback=64) * 1024 * 1024)
 
         self.names = self.getNames()
         self.bssids = self.getBssids()
@@ -43,136 +67,341 @@ class neoHandler:
         self.speeds = self.getSpeeds()
         self.lanips = self.getLanIPs()
 
-    
+    def ensureIndexes(self):
+        # Index population happens in the background on the server, so report progress from a
+        # watcher thread instead of blocking the login
+        self.indexState = self.indexStatus()
+        if self.indexesPopulating():
+            watcher = threading.Thread(target=self.__watchIndexes, name="index-watcher")
+            watcher.daemon = True
+            watcher.start()
+
+    def indexStatus(self):
+        # [(description, state, progress %)] for every index in the database
+        return self.store.indexStatus()
+
+    def indexesPopulating(self):
+        return any(state == "POPULATING" for _, state, _ in self.indexState)
+
+    def indexSummary(self):
+        online = sum(state == "ONLINE" for _, state, _ in self.indexState)
+        return f"{online}/{len(self.indexState)} online"
+
+    def __watchIndexes(self):
+        while self.indexesPopulating():
+            for description, state, progress in self.indexState:
+                if state != "ONLINE":
+                    print(f"Index {description}: {state} {progress:.0f}%")
+            sleep(2)
+            self.indexState = self.indexStatus()
+        print(f"Indexes: {self.indexSummary()}")
+
+    def profilePresets(self):
+        # PROFILE every search preset against real values from the catalog
+        return self.store.profilePresets(self.getCatalog())
+
+    @property
+    def dataVersion(self):
+        # Shared with the other worker processes of a headless server through VERSION_FILE
+        return self.versions.get('data')
+
+    def dataChanged(self):
+        # Bumped by anything that writes to the graph, cached reads compare against it
+        self.versions.bump('data')
+
+    @property
+    def settledVersion(self):
+        return self.versions.get('settled')
+
+    @property
+    def deleteGeneration(self):
+        return self.versions.get('deletes')
+
+    def dataSettled(self):
+        # Called once an ingest job, capture watcher pass or delete is done writing, in any worker
+        self.versions.set('settled', self.dataVersion)
+
+    def getCatalog(self):
+        # {prop: [(value, count), ...]} sorted by value, plus a lowercase prefix index per prop
+        with self.__catalogLock:
+            if self.__catalogVersion != self.dataVersion:
+                version = self.dataVersion
+                catalog = {prop: [] for prop in bg_presets.CATALOG_FIELDS + ['type']}
+                for prop, value, cnt in self.store.catalog():
+                    catalog[prop].append((value, cnt))
+                self.__catalog = {k: self.__sortValues(v) for k, v in catalog.items()}
+                self.__catalogIndex = {}
+                for prop, entries in self.__catalog.items():
+                    ordered = sorted(entries, key=lambda e: str(e[0]).lower())
+                    self.__catalogIndex[prop] = ([str(e[0]).lower() for e in ordered], ordered)
+                self.__catalogVersion = version
+            return self.__catalog
+
+    @staticmethod
+    def __sortValues(entries):
+        try:
+            return sorted(entries)
+        except TypeError:
+            return sorted(entries, key=lambda e: str(e[0]))
+
+    def searchCatalog(self, prop, text, limit=None):
+        # Typeahead for the filter dropdown: prefix matches first, then substring matches,
+        # most common values first within each group
+        limit = limit or self.TYPEAHEAD_LIMIT
+        self.getCatalog()
+        keys, entries = self.__catalogIndex[prop]
+        text = (text or "").lower()
+
+        lo = bisect.bisect_left(keys, text)
+        hi = bisect.bisect_left(keys, text + "\uffff")
+        byCount = lambda e: (-e[1], str(e[0]))
+        matches = heapq.nsmallest(limit, entries[lo:hi], key=byCount)
+        if len(matches) < limit and text:
+            contained = (e for k, e in zip(keys, entries) if text in k and not k.startswith(text))
+            matches += heapq.nsmallest(limit - len(matches), contained, key=byCount)
+
+        return matches
+
     def getNames(self):
-        return list(map(lambda x: x['name'], self.graph.run(bg_presets.NAMES_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['name']]
 
     def getBssids(self):
-        return list(map(lambda x: x['bssid'], self.graph.run(bg_presets.BSSID_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['bssid']]
     
     def getOUIs(self):
-        return list(map(lambda x: x['oui'], self.graph.run(bg_presets.OUI_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['oui']]
     
     def getTypes(self):
-        return list(map(lambda x: x['type'], self.graph.run(bg_presets.TYPE_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['type']]
     
     def getAuths(self):
-        return list(map(lambda x: x['auth'], self.graph.run(bg_presets.AUTH_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['auth']]
     
     def getCiphers(self):
-        return list(map(lambda x: x['cipher'], self.graph.run(bg_presets.CIPHER_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['cipher']]
     
     def getChannels(self):
-        return list(map(lambda x: x['channel'], self.graph.run(bg_presets.CHANNEL_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['channel']]
     
     def getSpeeds(self):
-        return list(map(lambda x: x['speed'], self.graph.run(bg_presets.SPEED_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['speed']]
 
     def getLanIPs(self):
-        return list(map(lambda x: x['lan'], self.graph.run(bg_presets.LANIP_QUERY).data()))
+        return [v for v, _ in self.getCatalog()['lan']]
 
     def getDbStats(self):
-        c = Counter()
-        nodeRes = self.graph.run('''MATCH (n) WITH DISTINCT labels(n) AS temp, COUNT(n) as tempCnt
-                                UNWIND temp AS label
-                                RETURN label, SUM(tempCnt) AS cnt''').data()
-        probeCnt = self.graph.run('MATCH ()-[r:Probes]->() RETURN count(r) AS probes').data()[0].get('probes')
-        assocCnt = self.graph.run('MATCH ()-[r:AssociatedTo]->() RETURN count(r) AS assoc').data()[0].get('assoc')
-        
-        for res in nodeRes:
-            c.update({res['label']: res['cnt']})
-        c.update({'Probes': probeCnt, 'Assoc': assocCnt})
+        # One round trip of count store lookups, only repeated after the data changes
+        version = self.dataVersion
+        if self.__stats is None or self.__statsVersion != version:
+            self.__stats = Counter(dict(self.store.stats()))
+            self.__statsVersion = version
+        return self.__stats
 
-        self.names = self.getNames()
-        return c
+    def dataToJSON(self, rows):
+        # Rows stream in as {a: node, b: node, edge: edge}, one per relationship or isolated node.
+        # Nodes and edges are keyed by id so the merge stays linear in the result size.
+        nodes, edges = {}, {}
 
-    def dataToJSON(self, relationJSON):
-        checkDupes, returnJson = {}, {}
-        returnJson['nodes'] = []
-        returnJson['edges'] = []
+        for row in rows:
+            for key in ('a', 'b'):
+                node = row.get(key)
+                if node is None:
+                    continue
+                if isinstance(node['type'], list):
+                    node['type'] = node['type'][0]
 
-        for idx, node in enumerate(relationJSON['nodes']):
-            node['type'] = node['type'][0]
-
-            #Merge nodes that are both APs and Clients (mesh)
-            if node['id'] not in checkDupes.values():
-                checkDupes[idx] = node['id']
-                returnJson['nodes'].append({"data": node, "selected": 'false', "group": "nodes"})
-            else:
-                inDupe = [key for (key, value) in checkDupes.items() if value == node['id']][0]
-                if node['type'] == "Client":
-                    node = {**node, **returnJson['nodes'][inDupe]['data']}
+                #Merge nodes that are both APs and Clients (mesh)
+                existing = nodes.get(node['id'])
+                if existing is None:
+                    nodes[node['id']] = {"data": node, "selected": 'false', "group": "nodes"}
+                elif node['type'] == "Client":
+                    existing['data'] = {**node, **existing['data']}
                 else:
-                    node = {**returnJson['nodes'][inDupe]['data'], **node}
-                returnJson['nodes'][inDupe]['data'] = node
-        
-        for idx, edge in enumerate(relationJSON['edges']):
-            returnJson['edges'].append({"data": edge, "selected": 'false', "group": "edges"})
+                    existing['data'] = {**existing['data'], **node}
+
+            edge = row.get('edge')
+            if edge is not None and edge['id'] not in edges:
+                edges[edge['id']] = {"data": edge, "selected": 'false', "group": "edges"}
 
-        return returnJson
+        return {'nodes': list(nodes.values()), 'edges': list(edges.values())}
 
     def initialQuery(self):
-        relations = self.graph.evaluate(bg_presets.INITIAL)
+        version = self.dataVersion
+        elements = self.resultCache.get(("INITIAL",), version)
+        if elements is None:
+            elements = self.dataToJSON(self.store.initial())
+            self.resultCache.put(("INITIAL",), version, elements)
         self.INITIAL = False
-        return self.dataToJSON(relations)
+        return elements
 
     def searchQuery(self, value, prop):
+        # Analysts flip between the same few filters, repeat searches come from the result cache
+        # until an ingest or deleteDB bumps the data version
+        version = self.dataVersion
+        values = value[:1] if prop == "type" else value
+        key = (prop, tuple(sorted(map(str, values))))
+        cached = self.resultCache.get(key, version)
+        if cached is not None:
+            return cached
+
         if prop == "type":
-            labelRelations = self.graph.evaluate(bg_presets.searchLabelRelations(value[0]))
-            labelNoRelations = self.graph.evaluate(bg_presets.searchLabelNoRelations(value[0]))
-            tempDict = {k:v + labelRelations[k] for k,v in labelNoRelations.items()}
-            merged = {**labelRelations, **tempDict}
+            rows = self.store.searchLabel(bg_presets.checkLabel(value[0]))
         else:
-            relations = self.graph.evaluate(bg_presets.searchRelations(value, prop))
-            noRelations = self.graph.evaluate(bg_presets.searchNoRelations(value, prop))
-            tempDict = {k:v + relations[k] for k,v in noRelations.items()}
-            merged = {**relations, **tempDict}
+            rows = self.store.searchNodes(bg_presets.checkProp(prop), value)
+
+        elements = self.dataToJSON(rows)
+        self.resultCache.put(key, version, elements)
+        return elements
+
+    def levelOfDetail(self, elements, prop=None):
+        # Results over the element budget are shown as clusters that expand on tap. One cluster per
+        # value can still be over it (e.g. one per ESSID), then only the biggest clusters are kept
+        # and the rest are folded into a single "other" cluster.
+        if self.__size(elements) <= self.ELEMENT_BUDGET:
+            return elements
+        return self.__fitBudget(elements, elements['nodes'], prop or self.CLUSTER_BY, {}, "cluster")
+
+    @staticmethod
+    def __size(elements):
+        return len(elements['nodes']) + len(elements['edges'])
+
+    def __fitBudget(self, elements, nodes, prop, clusters, scope):
+        # Cluster nodes by prop on top of the existing clusters, halving the number of new clusters
+        # until the view fits
+        groups = self.groupNodes(nodes, prop, scope)
+        limit = len(groups)
+        view = self.collapse(elements, {**clusters, **groups})
+        while self.__size(view) > self.ELEMENT_BUDGET and limit > 2:
+            limit = max(2, limit // 2)
+            view = self.collapse(elements, {**clusters, **self.groupNodes(nodes, prop, scope, limit)})
+        print(f"Clustered {len(nodes)} nodes into {len(view['clusters']) - len(clusters)} clusters by {prop}")
+        return view
+
+    def groupNodes(self, nodes, prop, scope="cluster", limit=None):
+        # {cluster id: {'label', 'members'}}. Nodes without prop are grouped by their type, e.g.
+        # clients have no channel. With a limit only the limit - 1 biggest groups keep their own
+        # cluster, the rest share an "other" one.
+        groups = {}
+        for node in nodes:
+            data = node['data']
+            if prop == 'prefix':
+                # Last resort for members nothing else splits: the first three octets of the MAC
+                value = (data.get('bssid') or "")[:8]
+            else:
+                value = data.get(prop) if prop != 'name' or data['type'] != "Client" else None
+            key = f"{scope}:{prop}:{value}" if value not in (None, "") else f"{scope}:type:{data['type']}"
+            group = groups.setdefault(key, {'label': f"{prop}: {value}" if value not in (None, "") else data['type'],
+                        'members': []})
+            group['members'].append(data['id'])
+
+        if limit and len(groups) > limit:
+            ordered = sorted(groups.items(), key=lambda g: -len(g[1]['members']))
+            other = {'label': f"{prop}: other", 'other': True,
+                        'members': [member for _, g in ordered[limit - 1:] for member in g['members']]}
+            groups = dict(ordered[:limit - 1] + [(f"{scope}:{prop}:other", other)])
+        return groups
+
+    def collapse(self, elements, clusters):
+        # The view of a search result with the given clusters collapsed into single nodes and the
+        # edges between them aggregated with counts. Cluster members stay on the server in
+        # 'clusters', ElementHistory keeps them with the view and they are never sent.
+        clusterOf = {member: cid for cid, cluster in clusters.items() for member in cluster['members']}
+        nodes = [{"data": {'id': cid, 'type': "Cluster", 'count': len(cluster['members']),
+                    'name': f"{cluster['label']} ({len(cluster['members'])})"}, "selected": 'false', "group": "nodes"}
+                    for cid, cluster in clusters.items()]
+        # Copies, the server layout adds positions to the nodes it is given
+        nodes += [dict(node) for node in elements['nodes'] if node['data']['id'] not in clusterOf]
+
+        edges = {}
+        for edge in elements['edges']:
+            data = edge['data']
+            source, target = clusterOf.get(data['source'], data['source']), clusterOf.get(data['target'], data['target'])
+            if source == target:
+                continue
+            if (source, target) == (data['source'], data['target']):
+                edges.setdefault(data['id'], edge)
+                continue
+            eid = f"{source}-{data['name']}-{target}"
+            agg = edges.setdefault(eid, {"data": {'id': eid, 'source': source, 'target': target, 'name': data['name'], 'count': 0},
+                        "selected": 'false', "group": "edges"})
+            agg['data']['count'] += 1
 
-        return self.dataToJSON(merged)
+        return {'nodes': nodes, 'edges': list(edges.values()), 'clusters': clusters}
 
-    def handleIncomingData(self, dType, data):
-        if dType == "Airodump":
-            self.insertAiroData(data)
+    def expandCluster(self, elements, clusterId, result, prop):
+        # Replace a cluster on screen with its members from the search result. Only edges inside
+        # the result are shown, neighbours in other clusters stay collapsed. When the members do not
+        # fit under the budget they are clustered again, by the next property that splits them.
+        clusters = dict(elements.get('clusters') or {})
+        cluster = clusters.pop(clusterId, None)
+        if cluster is None:
+            return None
+        view = self.collapse(result, clusters)
+        if self.__size(view) <= self.ELEMENT_BUDGET:
+            return view
+
+        members = set(cluster['members'])
+        nodes = [node for node in result['nodes'] if node['data']['id'] in members]
+        props = ([prop] if cluster.get('other') else []) + [p for p in CLUSTER_PROPS if p != prop] + ['prefix']
+        subProp = next((p for p in props if len(self.groupNodes(nodes, p, clusterId)) > 1), props[0])
+        return self.__fitBudget(result, nodes, subProp, clusters, clusterId)
+
+    def handleIncomingData(self, dType, data, job=None):
+        # Kismet logs are parsed into the same records as airodump captures
+        if dType in ("Airodump", "Kismet"):
+            self.insertAiroData(data, job)
     
-    def insertAiroData(self, data):
+    def insertAiroData(self, data, job=None):
         print("Inserting node data!")
         bssidNodes, stationNodes = data[0][0], data[0][1]
-        for b in bssidNodes:
-            try:
-                bNode = Node(b['type'], name=b['name'], bssid=b['bssid'], oui=b['oui'], encryption=b["encryption"], speed=b['speed'], channel=b['channel'], auth=b['auth'], cipher=b['cipher'], lan=b['lan'])
-                bNode.add_label("Device")
-                self.graph.create(bNode)
-            except ClientError:
-                pass
-        
+
+        stations, probedNames, probes, assocs = [], set(), [], []
         for essids, s in stationNodes:
-            sNode = self.graph.nodes.match("Device", bssid=s['bssid']).first()
-            if sNode is None:
-                sNode = Node(s["type"], name=s['name'], bssid=s['bssid'], FirstTimeSeen=s['fts'], LastTimeSeen=s['lts'],Power=s['pwr'], NumPackets=s['pkts'], Association=s['assoc'], oui=s['oui'])
-                sNode.add_label("Device")
-            else:
-                sNode['FirstTimeSeen'] = s['fts']
-                sNode['LastTimeSeen'] = s['lts']
-                sNode['Power'] = s['pwr']
-                sNode['NumPackets'] = s['pkts']
-                sNode['Association'] =s['assoc']
-                self.graph.push(sNode)
-                sNode = self.graph.nodes.match("Device", bssid=s['bssid']).first()
-
-            for essid in essids: 
-                nExisting = self.graph.nodes.match("Device", name=essid).first()
+            stations.append(s)
+            for essid in essids:
                 if len(essid) > 0:
-                    newProbe = Node("AP", name=essid)
-                    newProbe.add_label("Device")
-                    self.graph.create(Relationship(sNode, "Probes", nExisting or newProbe))
-            
+                    probedNames.add(essid)
+                    probes.append({'station': s['bssid'], 'essid': essid})
             if s['assoc'] is not None:
-                aExisting = self.graph.nodes.match("Device", bssid=s['assoc']).first()
-                newAssoc = Node("AP", bssid=s['assoc'])
-                newAssoc.add_label("Device")
-                self.graph.create(Relationship(sNode, "AssociatedTo", aExisting or newAssoc))
-        
+                assocs.append({'station': s['bssid'], 'assoc': s['assoc']})
+
+        self.writeAiroData(bssidNodes, stations, probedNames, probes, assocs, job)
         print("Database updated!")
 
+    def writeAiroData(self, bssidNodes, stations, probedNames, probes, assocs, job=None):
+        # Uploads pass everything, the capture watcher (bg_watch.py) only what changed since its last pass.
+        # Callers flush the store once they are done.
+        for label in bg_presets.AP_LABELS:
+            rows = [b for b in bssidNodes if b['type'] == label]
+            if label == "AP":
+                # AP names are unique, keep the first AP seen per name
+                rows = list({b['name']: b for b in reversed(rows)}.values())
+            self.runBatches(lambda batch: self.store.mergeBssidNodes(label, batch), rows, job)
+
+        self.runBatches(self.store.mergeStations, stations, job)
+        self.runBatches(self.store.mergeProbedAPs, sorted(probedNames), job)
+        self.runBatches(self.store.mergeProbes, probes, job)
+        self.runBatches(self.store.mergeAssociations, assocs, job)
+
+    def runBatches(self, write, rows, job=None):
+        # One transaction per batch keeps server memory bounded on large captures. write is one
+        # of the store's merge methods.
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            if job is not None:
+                job.checkCancelled()
+            nodes, edges = write(rows[i:i + self.BATCH_SIZE])
+            self.dataChanged()
+            if job is not None:
+                job.written(nodes, edges)
+
     def deleteDB(self):
-        self.graph.run(bg_presets.DELETEDB_QUERY)
+        self.store.deleteAll()
+        self.store.flush()
+        self.versions.bump('deletes')
+        self.dataChanged()
+        self.dataSettled()
+
+if __name__ == '__main__':
+    # Print the PROFILE plan of every preset: python neoHandler.py
+    neo = neoHandler(config['neo4j']['uri'], config['neo4j']['User'], config['neo4j']['Password'])
+    print(neo.profilePresets())